@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import random
+import time
+
+DEFAULT_ATTACH_CONCURRENCY = 4
+RETRY_BASE_DELAY = 1.0  # Seconds before the first retry of a failed attach.
+RETRY_MAX_DELAY = 300.0  # Upper bound for the retry delay of a repeatedly failing device.
+RETRY_JITTER = 0.5  # Up to +50% random jitter so failing devices don't retry in lockstep.
+
+
+class AttachScheduler:
+    """Runs device attaches concurrently and backs off devices that keep failing."""
+
+    def __init__(self, attach_func, max_concurrency: int = DEFAULT_ATTACH_CONCURRENCY):
+        # attach_func(local_port, busid) -> bool performs a single attach.
+        self._attach_func = attach_func
+        # Bounds attaches across all servers, since each one spawns a 'usbip attach'.
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        # Maps (server name, busid) to its consecutive failure count
+        self._failures = {}
+        # Maps (server name, busid) to the monotonic time its next attempt is allowed
+        self._retry_at = {}
+
+    def is_backing_off(self, server_name: str, busid: str) -> bool:
+        """Returns True if a device failed recently and its retry delay has not expired."""
+        return self._retry_at.get((server_name, busid), 0.0) > time.monotonic()
+
+    def next_retry_delay(self, server_name: str) -> float | None:
+        """Returns the seconds until the earliest pending retry for a server, if any."""
+        now = time.monotonic()
+        delays = [
+            retry_at - now
+            for (name, _), retry_at in self._retry_at.items()
+            if name == server_name and retry_at > now
+        ]
+        return min(delays) if delays else None
+
+    def forget_server(self, server_name: str):
+        """Drops all retry state for a server, e.g. after its tunnel was rebuilt."""
+        for key in [key for key in self._failures if key[0] == server_name]:
+            del self._failures[key]
+        for key in [key for key in self._retry_at if key[0] == server_name]:
+            del self._retry_at[key]
+
+    def _record_failure(self, server_name: str, busid: str):
+        key = (server_name, busid)
+        failures = self._failures.get(key, 0) + 1
+        self._failures[key] = failures
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (failures - 1))
+        delay *= 1 + random.uniform(0, RETRY_JITTER)
+        self._retry_at[key] = time.monotonic() + delay
+        logging.warning(
+            f"[{server_name}] Attach of {busid} failed {failures} time(s) in a row. "
+            f"Retrying in {delay:.1f}s."
+        )
+
+    def _record_success(self, server_name: str, busid: str):
+        self._failures.pop((server_name, busid), None)
+        self._retry_at.pop((server_name, busid), None)
+
+    async def _attach_one(self, server_name: str, local_port: int, busid: str) -> bool:
+        async with self._semaphore:
+            try:
+                attached = await self._attach_func(local_port, busid)
+            except Exception as e:
+                logging.error(f"[{server_name}] Unexpected error while attaching {busid}: {e}")
+                attached = False
+        if attached:
+            self._record_success(server_name, busid)
+        else:
+            self._record_failure(server_name, busid)
+        return attached
+
+    async def attach_all(self, server_name: str, local_port: int, busids: set, ports: dict | None = None) -> set:
+        """Attaches the given devices concurrently and returns the set that succeeded.
+
+        Devices still inside their retry delay are skipped and left for a later call.
+        ports optionally maps a busid to its own local port, overriding local_port.
+        """
+        ports = ports or {}
+        ready = sorted(busid for busid in busids if not self.is_backing_off(server_name, busid))
+        skipped = busids.difference(ready)
+        if skipped:
+            logging.debug(f"[{server_name}] Deferring attach of backing-off devices: {skipped}")
+        if not ready:
+            return set()
+
+        results = await asyncio.gather(
+            *(self._attach_one(server_name, ports.get(busid, local_port), busid) for busid in ready)
+        )
+        return {busid for busid, attached in zip(ready, results) if attached}
@@ -1,19 +1,38 @@
 import logging
 import asyncio
+import time
 from zeroconf import ServiceStateChange
 from zeroconf.asyncio import AsyncServiceBrowser, AsyncZeroconf
 
+from profiling import span
+
 SERVICE_TYPE = "_usbip._tcp.local."
+DEBOUNCE_DELAY = 0.25  # Seconds to let a burst of events for one service settle.
+INFO_CACHE_TTL = 60  # Seconds a resolved service info is reused for Added events.
+
+
+def _endpoint(info) -> tuple:
+    """Returns what identifies where a service can be reached."""
+    return (info.server, info.port, tuple(sorted(info.parsed_addresses())))
 
 
 class DiscoveryManager:
     """Discovers USB/IP servers on the network using Zeroconf."""
 
-    def __init__(self, add_callback, remove_callback):
+    def __init__(self, add_callback, remove_callback, update_callback=None):
         self._add_callback = add_callback
         self._remove_callback = remove_callback
+        # Called when a known service moves to another address or port.
+        self._update_callback = update_callback
         self.aiozc = None
         self.browser = None
+        # Maps a service name to the latest state change not processed yet
+        self._pending_changes = {}
+        # Maps a service name to (AsyncServiceInfo, expiry time)
+        self._info_cache = {}
+        # Maps a service name to the endpoint last reported through a callback
+        self._known_endpoints = {}
+        self._tasks = set()
 
     async def start(self):
         """Starts the Zeroconf browser."""
@@ -26,27 +45,74 @@ class DiscoveryManager:
     def on_service_state_change(
         self, zeroconf, service_type, name, state_change
     ):
-        """Callback for service state changes."""
-        logging.info(f"Service {name} state changed: {state_change.name}")
-        asyncio.create_task(self.handle_change(service_type, name, state_change))
+        """Callback for service state changes. Coalesces bursts of events per service."""
+        logging.debug(f"Service {name} state changed: {state_change.name}")
+        previous = self._pending_changes.get(name)
+        if previous is not None:
+            # An Updated right after an Added is still a new service to us.
+            if previous == ServiceStateChange.Added and state_change == ServiceStateChange.Updated:
+                state_change = ServiceStateChange.Added
+            self._pending_changes[name] = state_change
+            return
+        self._pending_changes[name] = state_change
+        task = asyncio.create_task(self._debounce(service_type, name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-    async def handle_change(self, service_type, name, state_change):
+    async def _debounce(self, service_type, name):
+        await asyncio.sleep(DEBOUNCE_DELAY)
+        state_change = self._pending_changes.pop(name)
+        try:
+            with span("discovery", service=name, change=state_change.name):
+                await self.handle_change(service_type, name, state_change)
+        except Exception as e:
+            logging.error(f"Error while handling discovery event for {name}: {e}")
+
+    async def _resolve(self, service_type, name, refresh: bool):
+        """Returns the service info, reusing an unexpired cached copy unless refresh is set."""
+        cached = self._info_cache.get(name)
+        if cached and not refresh and cached[1] > time.monotonic():
+            return cached[0]
         info = await self.aiozc.async_get_service_info(service_type, name)
-        if not info:
-            if state_change == ServiceStateChange.Removed:
+        if info:
+            self._info_cache[name] = (info, time.monotonic() + INFO_CACHE_TTL)
+        else:
+            self._info_cache.pop(name, None)
+        return info
+
+    async def handle_change(self, service_type, name, state_change):
+        if state_change == ServiceStateChange.Removed:
+            self._info_cache.pop(name, None)
+            if self._known_endpoints.pop(name, None) is not None:
                 logging.info(f"Server lost: {name}")
                 await self._remove_callback(name)
             return
 
-        if state_change == ServiceStateChange.Added or state_change == ServiceStateChange.Updated:
-            logging.info(f"Server discovered/updated: {name} at {info.server}")
+        # Updated events mean the records changed, so never answer them from the cache.
+        info = await self._resolve(service_type, name, refresh=state_change == ServiceStateChange.Updated)
+        if not info:
+            logging.debug(f"Could not resolve service info for {name}.")
+            return
+
+        endpoint = _endpoint(info)
+        known = self._known_endpoints.get(name)
+        self._known_endpoints[name] = endpoint
+        if known is None:
+            logging.info(f"Server discovered: {name} at {info.server}:{info.port}")
             await self._add_callback(info)
-        elif state_change == ServiceStateChange.Removed:
-            logging.info(f"Server lost: {name}")
-            await self._remove_callback(name)
+        elif known != endpoint:
+            logging.info(f"Server {name} moved to {info.server}:{info.port} {list(endpoint[2])}")
+            if self._update_callback:
+                await self._update_callback(info)
+        else:
+            logging.debug(f"Server {name} updated without address or port changes.")
 
     async def close(self):
-        """Shuts down the Zeroconf browser."""
+        """Shuts down the Zeroconf browser and any pending discovery work."""
         logging.info("Closing Zeroconf browser.")
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
         if self.aiozc:
-            await self.aiozc.async_close() 
\ No newline at end of file
+            await self.aiozc.async_close()
@@ -3,8 +3,13 @@ import logging
 import signal
 import argparse
 
-from ssh_manager import SSHManager
-from usb_manager import USBManager
+from attach_scheduler import DEFAULT_ATTACH_CONCURRENCY
+from metrics import MetricsServer
+import profiling
+from ssh_manager import DEFAULT_HANDSHAKE_CONCURRENCY, DEFAULT_RECONNECT_GRACE_PERIOD, SSHManager
+from state_store import StateStore
+from transport import BACKEND_AUTO, BACKEND_DIRECT, TRANSPORT_BACKENDS
+from usb_manager import DEVICE_ISOLATION_MODES, DEVICE_ISOLATION_PRIORITY, USBManager
 
 # Configure logging at the top level, but it will be overridden in main.
 logging.basicConfig(level="INFO", format='%(asctime)s - %(levelname)s - %(message)s')
@@ -12,16 +17,44 @@ logging.basicConfig(level="INFO", format='%(asctime)s - %(levelname)s - %(messag
 class BeamerClient:
     """Main client application."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        attach_concurrency: int = DEFAULT_ATTACH_CONCURRENCY,
+        ssh_backend: str = BACKEND_AUTO,
+        metrics_port: int = 0,
+        reconnect_grace_period: float = DEFAULT_RECONNECT_GRACE_PERIOD,
+        direct_mode: bool = False,
+        device_isolation: str = DEVICE_ISOLATION_PRIORITY,
+        handshake_concurrency: int = DEFAULT_HANDSHAKE_CONCURRENCY,
+    ):
+        if direct_mode:
+            logging.warning("Direct mode is enabled: USB/IP traffic is sent unencrypted, without SSH.")
+            ssh_backend = BACKEND_DIRECT
+        # Port assignments persisted across restarts.
+        self.state_store = StateStore()
+        self.state_store.load()
         # The USB manager is now independent.
-        self.usb_manager = USBManager()
+        self.usb_manager = USBManager(
+            attach_concurrency=attach_concurrency,
+            device_isolation=device_isolation,
+        )
         # The SSH manager orchestrates everything, using the usb_manager.
-        self.ssh_manager = SSHManager(self.usb_manager)
+        self.ssh_manager = SSHManager(
+            self.usb_manager,
+            transport_backend=ssh_backend,
+            state_store=self.state_store,
+            reconnect_grace_period=reconnect_grace_period,
+            handshake_concurrency=handshake_concurrency,
+        )
         self.shutdown_event = asyncio.Event()
+        # The optional metrics endpoint is disabled when no port is configured.
+        self.metrics_server = MetricsServer(metrics_port, self.ssh_manager.get_status) if metrics_port else None
 
     async def start(self):
         """Starts the client's main discovery loop and waits for shutdown."""
         logging.info("Starting USB Beamer Client...")
+        if self.metrics_server:
+            await self.metrics_server.start()
         await self.ssh_manager.start()
         logging.info("Service discovery is active. Client is running.")
         await self.shutdown_event.wait()
@@ -30,11 +63,23 @@ class BeamerClient:
         """Stops the client and all its managers."""
         logging.info("Stopping USB Beamer Client...")
         await self.ssh_manager.close()
+        if self.metrics_server:
+            await self.metrics_server.close()
         self.shutdown_event.set()
         logging.info("Client shutdown initiated.")
 
-async def main():
-    client = BeamerClient()
+async def main(args):
+    if args.profile:
+        await profiling.enable()
+    client = BeamerClient(
+        attach_concurrency=args.attach_concurrency,
+        ssh_backend=args.ssh_backend,
+        metrics_port=args.metrics_port,
+        reconnect_grace_period=args.reconnect_grace_period,
+        direct_mode=args.direct_mode,
+        device_isolation=args.device_isolation,
+        handshake_concurrency=args.handshake_concurrency,
+    )
 
     async def handle_shutdown_signal():
         logging.info("Shutdown signal received.")
@@ -49,6 +94,7 @@ async def main():
     except asyncio.CancelledError:
         logging.info("Main client task was cancelled.")
     finally:
+        await profiling.disable()
         logging.info("USB Beamer Client has shut down.")
 
 if __name__ == "__main__":
@@ -58,6 +104,53 @@ if __name__ == "__main__":
         default='INFO',
         help='The logging level (DEBUG, INFO, WARNING, ERROR, FATAL)'
     )
+    parser.add_argument(
+        '--attach-concurrency',
+        type=int,
+        default=DEFAULT_ATTACH_CONCURRENCY,
+        help='Maximum number of devices attached at the same time'
+    )
+    parser.add_argument(
+        '--ssh-backend',
+        choices=TRANSPORT_BACKENDS,
+        default=BACKEND_AUTO,
+        help='SSH implementation: in-process asyncssh, the openssh subprocess, or auto'
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=0,
+        help='Local port for the /metrics and /status endpoint (0 disables it)'
+    )
+    parser.add_argument(
+        '--reconnect-grace-period',
+        type=float,
+        default=DEFAULT_RECONNECT_GRACE_PERIOD,
+        help='Seconds to wait before detaching the devices of a lost tunnel (0 detaches at once). '
+             'Imports through the tunnel end with it, so this only delays their cleanup'
+    )
+    parser.add_argument(
+        '--direct-mode',
+        action='store_true',
+        help='Connect to servers over plain TCP without SSH (trusted LANs only)'
+    )
+    parser.add_argument(
+        '--device-isolation',
+        choices=DEVICE_ISOLATION_MODES,
+        default=DEVICE_ISOLATION_PRIORITY,
+        help='Devices that get their own connection: those with a priority class, or all'
+    )
+    parser.add_argument(
+        '--handshake-concurrency',
+        type=int,
+        default=DEFAULT_HANDSHAKE_CONCURRENCY,
+        help='Maximum number of SSH handshakes run at the same time'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help=f'Log event loop callbacks that block too long and write a trace to {profiling.PROFILE_TRACE_PATH}'
+    )
     args = parser.parse_args()
 
     # Validate the log level and default to INFO if it's invalid.
@@ -69,6 +162,6 @@ if __name__ == "__main__":
     logging.getLogger().setLevel(log_level)
 
     try:
-        asyncio.run(main())
+        asyncio.run(main(args))
     except KeyboardInterrupt:
         logging.info("USB Beamer Client stopped by user.") 
\ No newline at end of file
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import math
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LOOP_LAG_INTERVAL = 0.5  # Seconds between event loop lag samples.
+
+
+def _format_labels(labelnames, values, extra=None) -> str:
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, None, value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """A monotonically increasing count."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Counts observations into cumulative buckets, like a Prometheus histogram."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        for key, (counts, total) in self._values.items():
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", key, ("le", _format_value(bound)), count
+            yield f"{self.name}_sum", key, None, total
+            yield f"{self.name}_count", key, None, counts[-1]
+
+
+REGISTRY = []
+
+TUNNEL_CONNECT_SECONDS = Histogram(
+    "beamer_tunnel_connect_seconds", "Time to establish a tunnel and its forwards.", ["server"]
+)
+TUNNEL_RECONNECTS = Counter(
+    "beamer_tunnel_reconnects_total", "Tunnel connections lost and re-established.", ["server"]
+)
+TUNNEL_BYTES = Counter(
+    "beamer_tunnel_bytes_total", "Payload bytes relayed by transports that can observe them.", ["server", "direction"]
+)
+HEALTH_CHECK_RTT_SECONDS = Histogram(
+    "beamer_health_check_rtt_seconds", "Round trip time of end-to-end tunnel health probes.", ["server"]
+)
+HEALTH_CHECK_FAILURES = Counter(
+    "beamer_health_check_failures_total", "Failed tunnel health probes.", ["server"]
+)
+DEVICE_RTT_SECONDS = Histogram(
+    "beamer_device_rtt_seconds",
+    "USB/IP round trip time seen on the path each device is attached through.",
+    ["server", "busid", "channel"],
+)
+DEVICE_FAILURES = Counter(
+    "beamer_device_failures_total", "Attached devices the watchdog found broken.", ["server", "busid"]
+)
+DEVICE_RECOVERY_SECONDS = Histogram(
+    "beamer_device_recovery_seconds",
+    "Time from the watchdog finding a device broken to it being attached again.",
+    ["server", "busid"],
+)
+SYNC_DURATION_SECONDS = Histogram(
+    "beamer_sync_duration_seconds", "Duration of scan_and_sync_devices runs.", ["server"]
+)
+ATTACH_SECONDS = Histogram(
+    "beamer_attach_seconds", "Latency of single device attaches.", ["server", "result"]
+)
+DETACH_SECONDS = Histogram(
+    "beamer_detach_seconds", "Latency of batched vhci detach passes.", ["result"]
+)
+SUBPROCESS_SPAWNS = Counter(
+    "beamer_subprocess_spawns_total", "Subprocesses started by the client.", ["command"]
+)
+LOOP_LAG_SECONDS = Gauge(
+    "beamer_event_loop_lag_seconds", "How late the last event loop lag sample woke up."
+)
+
+
+def render_metrics() -> str:
+    """Returns all registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def monitor_loop_lag():
+    """Measures how late timer callbacks fire, which reveals blocking calls on the loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.set(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
+
+class MetricsServer:
+    """Serves /metrics (Prometheus text) and /status (JSON) from the client's event loop."""
+
+    def __init__(self, port: int, status_func, host: str = "127.0.0.1"):
+        self.port = port
+        self.host = host
+        # status_func() returns the JSON-serialisable snapshot served on /status.
+        self._status_func = status_func
+        self._runner = None
+        self._lag_task = None
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def _handle_status(self, request):
+        return web.json_response(self._status_func())
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        app.router.add_get("/status", self._handle_status)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._lag_task = asyncio.create_task(monitor_loop_lag())
+        logging.info(f"Metrics and status endpoint listening on http://{self.host}:{self.port}/")
+
+    async def close(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+        if self._runner:
+            await self._runner.cleanup()
+
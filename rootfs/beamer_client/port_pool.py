@@ -0,0 +1,93 @@
+import logging
+import socket
+
+
+class PortPoolExhausted(Exception):
+    """Raised when a pool has no free local port left."""
+
+
+def is_port_bindable(port: int, host: str = "127.0.0.1") -> bool:
+    """Checks whether a local port can be listened on right now."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # Same option the forwarders use, so ports in TIME_WAIT still count as free.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+        except OSError:
+            return False
+    return True
+
+
+class PortPool:
+    """Hands out local ports from a fixed range, reusing freed ones.
+
+    Ports can be reserved for an owner, e.g. the ports a server had before a restart,
+    so that it gets the same ones back. Reserved ports are only given to someone else
+    once every other port in the range is taken.
+    """
+
+    def __init__(self, name: str, start: int, size: int, probe=is_port_bindable):
+        self.name = name
+        self.start = start
+        self.end = start + size  # Exclusive.
+        self._probe = probe
+        # Maps an owner to the port it currently holds
+        self._allocated = {}
+        # Maps an owner to the port it held last time, which it gets back if possible
+        self._reserved = {}
+
+    def __contains__(self, port: int) -> bool:
+        return self.start <= port < self.end
+
+    def reserve(self, owner, port: int):
+        """Remembers an owner's previous port, to be preferred when it next asks for one."""
+        if port in self:
+            self._reserved[owner] = port
+
+    def _is_free(self, port: int) -> bool:
+        return port not in self._allocated.values() and self._probe(port)
+
+    def allocate(self, owner) -> int:
+        """Returns the owner's port, allocating one if it has none.
+
+        Tries the owner's reserved port first, then the lowest port that is neither held,
+        reserved for someone else nor already bound by another process.
+        """
+        port = self._allocated.get(owner)
+        if port is not None:
+            return port
+
+        reserved = self._reserved.get(owner)
+        if reserved is not None:
+            if self._is_free(reserved):
+                self._allocated[owner] = reserved
+                return reserved
+            logging.warning(f"[{owner}] Previous {self.name} port {reserved} is in use. Picking another one.")
+
+        held = set(self._allocated.values())
+        reserved_for_others = {port for name, port in self._reserved.items() if name != owner}
+        fallback = None
+        for port in range(self.start, self.end):
+            if port in held:
+                continue
+            if port in reserved_for_others:
+                fallback = fallback or port
+                continue
+            if self._probe(port):
+                self._allocated[owner] = port
+                self._reserved[owner] = port
+                return port
+
+        # Everything else is taken: hand out a port reserved for an owner that has not come back.
+        for port in range(fallback or self.end, self.end):
+            if port in reserved_for_others and port not in held and self._probe(port):
+                for name in [name for name, reserved in self._reserved.items() if reserved == port]:
+                    del self._reserved[name]
+                self._allocated[owner] = port
+                self._reserved[owner] = port
+                return port
+        raise PortPoolExhausted(f"No free {self.name} port left in {self.start}-{self.end - 1}.")
+
+    def release(self, owner):
+        """Returns an owner's port to the pool. It stays reserved for the owner until needed elsewhere."""
+        self._allocated.pop(owner, None)
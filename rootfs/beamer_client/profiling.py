@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+PROFILE_TRACE_PATH = "/data/beamer_trace.json"
+SLOW_CALLBACK_DURATION = 0.05  # Seconds a callback may block the event loop before it is reported.
+MAX_TRACE_EVENTS = 200_000  # Oldest events are dropped beyond this, keeping memory and file size bounded.
+FLUSH_INTERVAL = 30  # Seconds between trace file rewrites, so a crash loses little.
+
+_tracer = None
+
+
+class Tracer:
+    """Collects timing spans as Chrome trace events (viewable in Perfetto or chrome://tracing).
+
+    Each asyncio task gets its own track, so the spans of one task nest properly while
+    concurrent tasks are shown side by side.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.events = collections.deque(maxlen=MAX_TRACE_EVENTS)
+        self._pid = os.getpid()
+        self._started = time.perf_counter()
+        # Map a task, or a thread outside the loop, to its track number. Tasks are held
+        # weakly so finished ones can be freed.
+        self._task_tracks = weakref.WeakKeyDictionary()
+        self._thread_tracks = {}
+        self._next_track = 1
+        self._flush_task = None
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self._started) * 1e6
+
+    def _track(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        tracks, key = (self._task_tracks, task) if task is not None else (self._thread_tracks, threading.get_ident())
+        track = tracks.get(key)
+        if track is None:
+            track = self._next_track
+            self._next_track += 1
+            tracks[key] = track
+            name = task.get_name() if task is not None else threading.current_thread().name
+            self.events.append(
+                {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": track, "args": {"name": name}}
+            )
+        return track
+
+    def complete(self, name: str, category: str, started_us: float, args: dict):
+        self.events.append({
+            "name": name, "cat": category, "ph": "X", "pid": self._pid, "tid": self._track(),
+            "ts": round(started_us, 1), "dur": round(self._now_us() - started_us, 1), "args": args,
+        })
+
+    def instant(self, name: str, category: str, args: dict):
+        self.events.append({
+            "name": name, "cat": category, "ph": "i", "s": "p", "pid": self._pid, "tid": self._track(),
+            "ts": round(self._now_us(), 1), "args": args,
+        })
+
+    def _write(self, events: list):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Failed to write trace file {self.path}: {e}")
+
+    async def flush(self):
+        await asyncio.to_thread(self._write, list(self.events))
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Turns asyncio's debug-mode "Executing ... took N seconds" warnings into trace events."""
+
+    def emit(self, record):
+        if _tracer is not None and "took" in record.getMessage():
+            _tracer.instant("slow_callback", "loop", {"message": record.getMessage()})
+
+
+async def enable(path: str = PROFILE_TRACE_PATH, slow_callback_duration: float = SLOW_CALLBACK_DURATION):
+    """Starts tracing spans and reporting event loop callbacks that block for too long."""
+    global _tracer
+    _tracer = Tracer(path)
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = slow_callback_duration
+    logging.getLogger("asyncio").addHandler(_SlowCallbackHandler())
+    _tracer._flush_task = asyncio.create_task(_tracer._flush_periodically())
+    logging.info(
+        f"Profiling enabled: callbacks blocking over {slow_callback_duration * 1000:.0f} ms are logged, "
+        f"trace written to {path}."
+    )
+
+
+async def disable():
+    """Stops tracing and writes the trace file."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return
+    if tracer._flush_task:
+        tracer._flush_task.cancel()
+    await tracer.flush()
+    logging.info(f"Trace with {len(tracer.events)} events written to {tracer.path}.")
+
+
+@contextlib.contextmanager
+def span(name: str, category: str = "client", **args):
+    """Records the duration of the enclosed block as a trace span. Free when profiling is off."""
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    started_us = tracer._now_us()
+    try:
+        yield
+    finally:
+        tracer.complete(name, category, started_us, args)
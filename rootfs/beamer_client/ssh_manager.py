@@ -1,38 +1,107 @@
 import asyncio
 import logging
+import time
+from dataclasses import dataclass
 from zeroconf.asyncio import AsyncServiceInfo
 
 from discovery_manager import DiscoveryManager
+from metrics import DEVICE_RTT_SECONDS, TUNNEL_CONNECT_SECONDS, TUNNEL_RECONNECTS
+from ssh_tuning import select_ciphers
+from port_pool import PortPool, PortPoolExhausted
+from profiling import span
+from state_store import StateStore
+from transport import (
+    BACKEND_AUTO,
+    BACKEND_DIRECT,
+    PRIORITY_NORMAL,
+    TunnelError,
+    create_transport,
+    resolve_backend,
+)
+from tunnel_health import ReconnectBackoff, TunnelHealthMonitor
 from usb_manager import USBManager
 
 # Constants
 PRIVATE_KEY_PATH = "/data/id_rsa"
 STARTING_LOCAL_PORT = 13240
+PORT_POOL_SIZE = 1000  # Local ports per pool; the usbip, HTTP and device channel pools are adjacent.
 SSH_USER = "root"
 USBIP_REMOTE_PORT = 3240
 REMOTE_HTTP_PORT = 5000  # The port the server's web UI is on.
-LOCAL_HTTP_PORT_OFFSET = 1000 # Offset to calculate local port for HTTP forwarding.
+STARTING_HTTP_PORT = STARTING_LOCAL_PORT + PORT_POOL_SIZE
+SYNC_INTERVAL = 15  # Polling interval for servers that do not push changes.
+PUSH_SYNC_INTERVAL = 300  # Safety-net resync interval while change pushes are active.
+PUSH_RESUBSCRIBE_DELAY = 5  # Wait before re-subscribing after a change stream drops.
+# Seconds to wait before cleaning up a lost tunnel's devices. Imports run through the tunnel's
+# forwards, so the kernel drops them with it; waiting only delays their cleanup.
+DEFAULT_RECONNECT_GRACE_PERIOD = 0
+DEVICE_CHANNEL_START_PORT = STARTING_HTTP_PORT + PORT_POOL_SIZE  # First local port for per-device connections.
+DEFAULT_HANDSHAKE_CONCURRENCY = 4  # SSH handshakes allowed to run at the same time.
+DEVICE_WATCHDOG_INTERVAL = 3  # Seconds between checks of every attached device's vhci port.
+
+
+@dataclass
+class DeviceChannel:
+    """A connection of its own that carries a single device's USB/IP traffic."""
+    transport: object
+    local_port: int
+    priority: str
+    monitor: TunnelHealthMonitor
+    monitor_task: asyncio.Task
+
 
 class SSHManager:
     """Manages dynamic SSH tunnels to discovered servers."""
 
-    def __init__(self, usb_manager: USBManager):
+    def __init__(
+        self,
+        usb_manager: USBManager,
+        transport_backend: str = BACKEND_AUTO,
+        state_store: StateStore | None = None,
+        reconnect_grace_period: float = DEFAULT_RECONNECT_GRACE_PERIOD,
+        handshake_concurrency: int = DEFAULT_HANDSHAKE_CONCURRENCY,
+    ):
         self.user = SSH_USER
         self.usb_manager = usb_manager
+        self.transport_backend = resolve_backend(transport_backend)
         self.tunnels = {}  # Maps server name to the tunnel task
         self.servers = {}  # Maps server name to the ServiceInfo object
         self.port_mapping = {}  # Maps server name to its assigned local usbip port
         self.http_port_mapping = {} # Maps server name to its assigned local http port
-        self.next_local_port = STARTING_LOCAL_PORT
-        
+        self.transports = {}  # Maps server name to its current transport
+        self.cipher_benchmark = {}  # Maps cipher name to measured MB/s, fastest first
+        self.device_channels = {}  # Maps (server name, busid) to its DeviceChannel
+        self.usbip_ports = PortPool("usbip", STARTING_LOCAL_PORT, PORT_POOL_SIZE)
+        self.http_ports = PortPool("HTTP", STARTING_HTTP_PORT, PORT_POOL_SIZE)
+        self.device_ports = PortPool("device channel", DEVICE_CHANNEL_START_PORT, PORT_POOL_SIZE)
+        # Bounds concurrent handshakes, so a cold start with many servers does not saturate the CPU.
+        self._handshake_slots = asyncio.Semaphore(max(1, handshake_concurrency))
+        self.state_store = state_store
+        # 0 restores the old behaviour of detaching everything as soon as a tunnel drops.
+        self.reconnect_grace_period = reconnect_grace_period
+        if state_store is not None:
+            # Give every persisted server its previous ports back when it reappears.
+            for name in state_store.servers:
+                ports = state_store.get_ports(name)
+                if ports:
+                    self.usbip_ports.reserve(name, ports[0])
+                    self.http_ports.reserve(name, ports[1])
+
+        usb_manager.channel_opener = self.open_device_channel
+        usb_manager.channel_closer = self.close_device_channel
+
         logging.info(f"SSH connections will use hardcoded username: '{self.user}'")
+        logging.info(f"SSH transport backend: {self.transport_backend}")
         self.discovery = DiscoveryManager(
             add_callback=self.add_server,
-            remove_callback=self.remove_server
+            remove_callback=self.remove_server,
+            update_callback=self.update_server,
         )
 
     async def start(self):
-        """Starts the discovery manager."""
+        """Picks the fastest cipher for this CPU, then starts the discovery manager."""
+        if self.transport_backend != BACKEND_DIRECT:
+            self.cipher_benchmark = await select_ciphers()
         await self.discovery.start()
 
     async def add_server(self, info: AsyncServiceInfo):
@@ -41,9 +110,15 @@ class SSHManager:
         if name in self.servers:
             return  # Already managing a tunnel for this server
 
-        local_port = self.next_local_port
-        self.next_local_port += 1
-        local_http_port = local_port + LOCAL_HTTP_PORT_OFFSET
+        try:
+            local_port = self.usbip_ports.allocate(name)
+            local_http_port = self.http_ports.allocate(name)
+        except PortPoolExhausted as e:
+            logging.error(f"[{name}] Cannot manage server: {e}")
+            self.usbip_ports.release(name)
+            return
+        if self.state_store:
+            self.state_store.set_ports(name, local_port, local_http_port)
 
         self.servers[name] = info
         self.port_mapping[name] = local_port
@@ -52,11 +127,34 @@ class SSHManager:
         task = asyncio.create_task(self._maintain_tunnel(info, local_port, local_http_port))
         self.tunnels[name] = task
 
+    async def update_server(self, info: AsyncServiceInfo):
+        """Restarts only the tunnel of a known server whose address or port changed."""
+        name = info.name
+        if name not in self.servers:
+            await self.add_server(info)
+            return
+
+        self.servers[name] = info
+        old_tunnel = self.tunnels.get(name)
+        if old_tunnel:
+            old_tunnel.cancel()
+            # The cancelled tunnel closes its transport and waits for the local ports to be released.
+            await asyncio.gather(old_tunnel, return_exceptions=True)
+        # Devices imported through the old tunnel cannot survive the move.
+        await self.usb_manager.close_server_session(name)
+        await self.usb_manager.detach_all_for_server(name)
+
+        logging.info(f"[{name}] Restarting tunnel for new address {info.server}:{info.port}.")
+        local_port = self.port_mapping[name]
+        local_http_port = self.http_port_mapping[name]
+        self.tunnels[name] = asyncio.create_task(self._maintain_tunnel(info, local_port, local_http_port))
+
     async def remove_server(self, name: str):
         """Stops the SSH tunnel and detaches devices for a lost server."""
         # First, schedule the detachment of all associated USB devices.
         # This is now an async function.
         asyncio.create_task(self.usb_manager.detach_all_for_server(name))
+        asyncio.create_task(self.usb_manager.close_server_session(name))
 
         # Then, proceed with tearing down the connection.
         if name in self.tunnels:
@@ -68,36 +166,152 @@ class SSHManager:
             del self.port_mapping[name]
         if name in self.http_port_mapping:
             del self.http_port_mapping[name]
+        self.usbip_ports.release(name)
+        self.http_ports.release(name)
+        self.transports.pop(name, None)
 
     def get_active_ports(self) -> dict:
         """Returns a mapping of server names to their local ports."""
         return self.port_mapping.copy()
 
-    async def _is_tunnel_alive(self, local_port: int) -> bool:
-        """Checks if the tunnel is alive by trying to connect to the local port."""
-        try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection("127.0.0.1", local_port),
-                timeout=3.0
-            )
-            writer.close()
-            await writer.wait_closed()
-            return True
-        except (ConnectionRefusedError, asyncio.TimeoutError):
-            return False
-        except Exception as e:
-            logging.debug(f"Tunnel check for port {local_port} failed with unexpected error: {e}")
-            return False
-
-    async def _monitor_tunnel_health(self, name: str, local_port: int, process):
-        """Monitors the tunnel's health and terminates the process if it fails."""
-        while process.returncode is None:
-            await asyncio.sleep(10)  # Health check interval
-            if not await self._is_tunnel_alive(local_port):
+    def get_status(self) -> dict:
+        """Returns a JSON-serialisable snapshot of the managed servers and their ports."""
+        return {
+            "transport_backend": self.transport_backend,
+            "cipher_benchmark_mb_per_s": self.cipher_benchmark,
+            "servers": {
+                name: {
+                    "address": info.server,
+                    "ssh_port": info.port,
+                    "local_port": self.port_mapping.get(name),
+                    "local_http_port": self.http_port_mapping.get(name),
+                    "transport": self.transports[name].get_status() if name in self.transports else None,
+                    "device_channels": {
+                        busid: {
+                            "local_port": channel.local_port,
+                            "priority": channel.priority,
+                            "smoothed_rtt_ms": (
+                                channel.monitor.smoothed_rtt * 1000 if channel.monitor.smoothed_rtt else None
+                            ),
+                            "transport": channel.transport.get_status(),
+                        }
+                        for (server_name, busid), channel in self.device_channels.items()
+                        if server_name == name
+                    },
+                }
+                for name, info in self.servers.items()
+            },
+            "devices": self.usb_manager.get_status(),
+        }
+
+    async def _monitor_tunnel_health(self, name: str, local_port: int, transport, server_name=None, monitor=None):
+        """Probes the tunnel end to end and closes the transport if it fails.
+
+        Every successful probe is also recorded as the round trip time of the devices
+        that travel through this tunnel, so shared and dedicated paths can be compared.
+        """
+        monitor = monitor or TunnelHealthMonitor(name, local_port)
+        while transport.is_open:
+            await asyncio.sleep(monitor.interval)
+            if not await monitor.check():
                 logging.warning(f"[{name}] Tunnel health check failed. Terminating connection.")
-                if process.returncode is None:
-                    process.terminate()
+                transport.close()
                 break
+            if monitor.last_rtt is not None:
+                self._record_device_rtt(server_name or name, local_port, monitor.last_rtt)
+            if server_name is None and monitor.devices is not None:
+                # The probe already lists the server's devices, so keep their metadata current for free.
+                self.usb_manager.record_remote_devices(name, monitor.devices)
+
+    def _record_device_rtt(self, server_name: str, local_port: int, rtt: float):
+        usb_manager = self.usb_manager
+        device_ports = usb_manager.device_ports_by_server.get(server_name, {})
+        for busid in usb_manager.attached_devices_by_server.get(server_name, set()):
+            if device_ports.get(busid, usb_manager.local_ports_by_server.get(server_name)) == local_port:
+                channel = "dedicated" if busid in device_ports else "shared"
+                DEVICE_RTT_SECONDS.observe(rtt, server=server_name, busid=busid, channel=channel)
+
+    def _create_transport(self, name: str, info: AsyncServiceInfo, forwards: list, priority: str = PRIORITY_NORMAL):
+        """Builds a transport that forwards (local port, remote port) pairs to a server."""
+        return create_transport(
+            self.transport_backend,
+            name,
+            info.server,
+            info.port,
+            self.user,
+            PRIVATE_KEY_PATH,
+            forwards,
+            ciphers=list(self.cipher_benchmark) or None,
+            priority=priority,
+        )
+
+    async def open_device_channel(self, server_name: str, busid: str, priority: str) -> int | None:
+        """Returns the local port of a connection dedicated to one device, opening it if needed.
+
+        Each channel is a separate connection to the server, so a bulk device cannot
+        hold up a latency sensitive one behind it in a shared TCP stream.
+        """
+        key = (server_name, busid)
+        channel = self.device_channels.get(key)
+        if channel is not None:
+            if channel.transport.is_open:
+                return channel.local_port
+            await self.close_device_channel(server_name, busid)
+        info = self.servers.get(server_name)
+        if info is None:
+            return None
+
+        name = f"{server_name}/{busid}"
+        try:
+            local_port = self.device_ports.allocate(key)
+        except PortPoolExhausted as e:
+            logging.warning(f"[{name}] {e}")
+            return None
+        transport = self._create_transport(name, info, [(local_port, USBIP_REMOTE_PORT)], priority)
+        try:
+            await self._start_transport(transport)
+        except TunnelError as e:
+            logging.warning(f"[{name}] Dedicated channel could not be established: {e}")
+            await transport.aclose()
+            self.device_ports.release(key)
+            return None
+        except BaseException:
+            # Cancelled, or failed unexpectedly: do not leak the half-open transport or its port.
+            await transport.aclose()
+            self.device_ports.release(key)
+            raise
+        logging.info(f"[{name}] Dedicated {priority} channel ready on local port {local_port}.")
+        monitor = TunnelHealthMonitor(name, local_port)
+        monitor_task = asyncio.create_task(
+            self._monitor_tunnel_health(name, local_port, transport, server_name, monitor)
+        )
+        self.device_channels[key] = DeviceChannel(transport, local_port, priority, monitor, monitor_task)
+        return local_port
+
+    async def _start_transport(self, transport):
+        """Starts a transport once a handshake slot is free."""
+        async with self._handshake_slots:
+            connect_started = time.monotonic()
+            with span("tunnel_setup", server=transport.name, backend=type(transport).__name__):
+                await transport.start()
+            TUNNEL_CONNECT_SECONDS.observe(time.monotonic() - connect_started, server=transport.name)
+
+    async def close_device_channel(self, server_name: str, busid: str):
+        """Closes a device's dedicated connection and frees its local port."""
+        channel = self.device_channels.pop((server_name, busid), None)
+        if channel is None:
+            return
+        channel.monitor_task.cancel()
+        await channel.transport.aclose()
+        self.device_ports.release((server_name, busid))
+
+    async def _expire_grace_period(self, name: str):
+        """Detaches a server's devices once its tunnel stayed down for the whole grace period."""
+        await asyncio.sleep(self.reconnect_grace_period)
+        logging.warning(
+            f"[{name}] Tunnel still down after the {self.reconnect_grace_period}s grace period. Detaching devices."
+        )
+        await asyncio.shield(self.usb_manager.detach_all_for_server(name))
 
     async def _maintain_tunnel(self, info: AsyncServiceInfo, local_port: int, local_http_port: int):
         """Creates and maintains a single SSH tunnel, reconnecting on failure."""
@@ -108,85 +322,150 @@ class SSHManager:
         
         sync_task = None
         health_check_task = None
-        while True:
-            process = None
-            try:
-                cmd = [
-                    "ssh",
-                    "-p", str(ssh_port),
-                    "-i", PRIVATE_KEY_PATH,
-                    "-L", f"{local_port}:localhost:{USBIP_REMOTE_PORT}",
-                    "-L", f"{local_http_port}:localhost:{REMOTE_HTTP_PORT}",
-                    f"{self.user}@{address}",
-                    "-N",
-                    "-o", "StrictHostKeyChecking=no",
-                    "-o", "ExitOnForwardFailure=yes",
-                    "-o", "ServerAliveInterval=15",
-                    "-o", "ServerAliveCountMax=3",
-                ]
-                process = await asyncio.create_subprocess_exec(*cmd)
-                logging.info(f"[{info.name}] SSH tunnel process started on local port {local_port}.")
-
-                # Wait for the tunnel to become responsive.
-                tunnel_ready = False
-                for i in range(15):  # Try for up to 15 seconds
-                    if await self._is_tunnel_alive(local_port):
-                        logging.info(f"[{info.name}] Tunnel is now responsive.")
-                        tunnel_ready = True
-                        break
-                    await asyncio.sleep(1)
-
-                if not tunnel_ready:
-                    logging.warning(f"[{info.name}] Tunnel did not become responsive in time.")
-                    if process.returncode is None:
-                        process.terminate()
-                    continue  # This will trigger the reconnect logic after a delay
-
-                # Start periodic tasks for device sync and health monitoring.
-                sync_task = asyncio.create_task(self._periodic_sync(info.name, local_port, local_http_port))
-                health_check_task = asyncio.create_task(
-                    self._monitor_tunnel_health(info.name, local_port, process)
+        watchdog_task = None
+        backoff = ReconnectBackoff()
+        was_connected = False
+        grace_task = None
+        try:
+            while True:
+                transport = self._create_transport(
+                    info.name, info, [(local_port, USBIP_REMOTE_PORT), (local_http_port, REMOTE_HTTP_PORT)]
                 )
+                self.transports[info.name] = transport
+                try:
+                    await self._start_transport(transport)
+                    if was_connected:
+                        TUNNEL_RECONNECTS.inc(server=info.name)
+                    was_connected = True
+                    logging.info(f"[{info.name}] Tunnel is now responsive.")
+                    if grace_task is not None:
+                        if not grace_task.done():
+                            # Back within the grace period: drop the imports that died with the tunnel, re-import them.
+                            grace_task.cancel()
+                            await self.usb_manager.reconcile_after_reconnect(info.name)
+                        grace_task = None
 
-                # Wait for the SSH process to terminate or for the health check to fail.
-                await process.wait()
+                    # Start periodic tasks for device sync and health monitoring.
+                    backoff.connected()
+                    self.usb_manager.mark_reconnect(info.name)
+                    sync_task = asyncio.create_task(self._periodic_sync(info.name, local_port, local_http_port))
+                    health_check_task = asyncio.create_task(
+                        self._monitor_tunnel_health(info.name, local_port, transport)
+                    )
+                    watchdog_task = asyncio.create_task(self._device_watchdog(info.name, local_port))
 
-            except asyncio.CancelledError:
-                logging.info(f"Tunnel for {info.name} is stopping.")
-                if process and process.returncode is None:
-                    process.terminate()
-                break
-            except Exception as e:
-                logging.error(f"Error with tunnel for {info.name}: {e}")
+                    # Wait for the connection to drop or for the health check to fail.
+                    await transport.wait_closed()
 
-            finally:
-                if sync_task:
-                    sync_task.cancel()
-                if health_check_task:
-                    health_check_task.cancel()
+                except TunnelError as e:
+                    logging.warning(f"[{info.name}] Tunnel could not be established: {e}")
+                except asyncio.CancelledError:
+                    logging.info(f"Tunnel for {info.name} is stopping.")
+                    break
+                except Exception as e:
+                    logging.error(f"Error with tunnel for {info.name}: {e}")
 
-            # If the loop continues, it means the connection was lost. Detach devices.
-            logging.warning(f"Tunnel for {info.name} disconnected. Detaching devices before reconnecting...")
-            await self.usb_manager.detach_all_for_server(info.name)
-            await asyncio.sleep(10)
+                finally:
+                    if sync_task:
+                        sync_task.cancel()
+                    if health_check_task:
+                        health_check_task.cancel()
+                    if watchdog_task:
+                        watchdog_task.cancel()
+                    # Only returns once the local ports are released, so a new transport can bind them.
+                    await transport.aclose()
 
-    async def _periodic_sync(self, server_name: str, local_port: int, local_http_port: int):
-        """The background task that periodically calls the USBManager to sync devices."""
+                # If the loop continues, it means the connection was lost.
+                await self.usb_manager.close_server_session(info.name)
+                if self.reconnect_grace_period <= 0:
+                    logging.warning(f"Tunnel for {info.name} disconnected. Detaching devices before reconnecting...")
+                    await self.usb_manager.detach_all_for_server(info.name)
+                elif grace_task is None:
+                    logging.warning(
+                        f"Tunnel for {info.name} disconnected. Detaching its devices in "
+                        f"{self.reconnect_grace_period}s unless it is back by then..."
+                    )
+                    grace_task = asyncio.create_task(self._expire_grace_period(info.name))
+                delay = backoff.next_delay()
+                logging.info(f"[{info.name}] Reconnecting in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+        finally:
+            if grace_task is not None:
+                grace_task.cancel()
+
+    async def _device_watchdog(self, server_name: str, local_port: int):
+        """Repairs individual devices whose vhci port failed while the tunnel stays up."""
         while True:
+            await asyncio.sleep(DEVICE_WATCHDOG_INTERVAL)
             try:
-                await self.usb_manager.scan_and_sync_devices(server_name, local_port, local_http_port)
-                await asyncio.sleep(15)  # Sync interval
+                with span("device_watchdog", server=server_name):
+                    await self.usb_manager.check_attached_devices(server_name, local_port)
             except asyncio.CancelledError:
-                logging.info(f"[{server_name}] Device sync loop stopped.")
-                break
+                raise
             except Exception as e:
-                logging.error(f"[{server_name}] Error in device sync loop: {e}")
-                # Wait longer after an error to avoid spamming logs.
-                await asyncio.sleep(30)
+                logging.error(f"[{server_name}] Error in device watchdog: {e}")
+
+    async def _watch_device_changes(self, server_name: str, local_http_port: int, sync_requested: asyncio.Event):
+        """Keeps a change subscription open to the server and requests a sync on every change."""
+        while True:
+            try:
+                supported = await self.usb_manager.watch_exported_devices(
+                    server_name, local_http_port, sync_requested.set
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.debug(f"[{server_name}] Device change stream failed: {e!r}")
+                supported = True
+            if not supported:
+                return
+            # We may have missed changes while the stream was down.
+            sync_requested.set()
+            await asyncio.sleep(PUSH_RESUBSCRIBE_DELAY)
+
+    async def _periodic_sync(self, server_name: str, local_port: int, local_http_port: int):
+        """The background task that calls the USBManager to sync devices on change or on a timer."""
+        sync_requested = asyncio.Event()
+        watch_task = asyncio.create_task(
+            self._watch_device_changes(server_name, local_http_port, sync_requested)
+        )
+        try:
+            while True:
+                try:
+                    sync_requested.clear()
+                    await self.usb_manager.scan_and_sync_devices(server_name, local_port, local_http_port)
+                    # Keep polling while the server pushes nothing, or while attaches are still pending.
+                    if (server_name in self.usb_manager.push_enabled_servers
+                            and not self.usb_manager.has_pending_attaches(server_name)):
+                        interval = PUSH_SYNC_INTERVAL
+                    else:
+                        interval = SYNC_INTERVAL
+                    # Wake up early when a backed-off attach becomes due.
+                    retry_delay = self.usb_manager.next_retry_delay(server_name)
+                    if retry_delay is not None:
+                        interval = min(interval, retry_delay)
+                    try:
+                        await asyncio.wait_for(sync_requested.wait(), timeout=interval)
+                    except asyncio.TimeoutError:
+                        pass
+                except asyncio.CancelledError:
+                    logging.info(f"[{server_name}] Device sync loop stopped.")
+                    break
+                except Exception as e:
+                    logging.error(f"[{server_name}] Error in device sync loop: {e}")
+                    # Wait longer after an error to avoid spamming logs.
+                    await asyncio.sleep(30)
+        finally:
+            watch_task.cancel()
 
     async def close(self):
-        """Closes all active SSH tunnels and discovery."""
+        """Closes all active SSH tunnels and discovery, and writes out pending state."""
         logging.info("Closing all SSH tunnels and discovery service...")
         await self.discovery.close()
         for tunnel in self.tunnels.values():
-            tunnel.cancel() 
\ No newline at end of file
+            tunnel.cancel()
+        for server_name, busid in list(self.device_channels):
+            await self.close_device_channel(server_name, busid)
+        await self.usb_manager.close()
+        if self.state_store is not None:
+            await self.state_store.flush() 
\ No newline at end of file
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import logging
+import os
+
+STATE_FILE_PATH = "/data/beamer_state.json"
+SAVE_DELAY = 1.0  # Seconds to coalesce bursts of changes into a single write.
+
+
+class StateStore:
+    """Persists the local ports of each server so a restart gives it the same ones back.
+
+    Device attachments are not persisted: their USB/IP connections run through forwards
+    owned by this process, so none of them outlive a restart.
+    """
+
+    def __init__(self, path: str = STATE_FILE_PATH):
+        self.path = path
+        # Maps a server name to {"local_port", "local_http_port"}
+        self.servers = {}
+        self._save_handle = None
+        # The scheduled flush, held here since the event loop only keeps weak references to tasks
+        self._flush_task = None
+
+    def load(self):
+        """Loads the persisted state, starting empty if there is none or it is unreadable."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.servers = {
+                name: {
+                    "local_port": entry.get("local_port"),
+                    "local_http_port": entry.get("local_http_port"),
+                }
+                for name, entry in data.get("servers", {}).items()
+            }
+            logging.info(f"Loaded persisted state for {len(self.servers)} server(s) from {self.path}.")
+        except FileNotFoundError:
+            self.servers = {}
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            logging.warning(f"Ignoring unreadable state file {self.path}: {e}")
+            self.servers = {}
+
+    def get_ports(self, server_name: str) -> tuple[int, int] | None:
+        """Returns the (local_port, local_http_port) last used for a server, if any."""
+        entry = self.servers.get(server_name)
+        if not entry or entry.get("local_port") is None or entry.get("local_http_port") is None:
+            return None
+        return entry["local_port"], entry["local_http_port"]
+
+    def set_ports(self, server_name: str, local_port: int, local_http_port: int):
+        self.servers[server_name] = {"local_port": local_port, "local_http_port": local_http_port}
+        self.schedule_save()
+
+    def schedule_save(self):
+        """Writes the state shortly, coalescing further changes made in the meantime."""
+        if self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(self._snapshot())
+            return
+        self._save_handle = loop.call_later(SAVE_DELAY, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """Writes pending changes now."""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        task = self._flush_task
+        if task is not None and task is not asyncio.current_task():
+            # Let a scheduled write finish first, so two writes never share the temporary file.
+            await asyncio.gather(task, return_exceptions=True)
+        try:
+            await asyncio.to_thread(self._write, self._snapshot())
+        finally:
+            if self._flush_task is asyncio.current_task():
+                self._flush_task = None
+
+    def _snapshot(self) -> dict:
+        return {"servers": json.loads(json.dumps(self.servers))}
+
+    def _write(self, data: dict):
+        # Write to a temporary file first so a crash never leaves a truncated state file.
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Failed to save state to {self.path}: {e}")
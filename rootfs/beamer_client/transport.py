@@ -0,0 +1,384 @@
+import abc
+import asyncio
+import logging
+import socket
+import time
+
+try:
+    import asyncssh
+    import asyncssh.encryption  # For its default cipher order.
+except ImportError:  # Optional dependency; the OpenSSH backend works without it.
+    asyncssh = None
+
+from metrics import SUBPROCESS_SPAWNS, TUNNEL_BYTES
+
+BACKEND_AUTO = "auto"
+BACKEND_ASYNCSSH = "asyncssh"
+BACKEND_OPENSSH = "openssh"
+BACKEND_DIRECT = "direct"  # Plain TCP on trusted LANs, no SSH. Only selected explicitly.
+TRANSPORT_BACKENDS = (BACKEND_AUTO, BACKEND_ASYNCSSH, BACKEND_OPENSSH)
+
+CONNECT_TIMEOUT = 15  # Seconds allowed for a tunnel to become usable.
+CLOSE_TIMEOUT = 5  # Seconds an ssh process gets to exit after SIGTERM before it is killed.
+# The end-to-end health check does the fast detection; keepalives only need to
+# reap dead connections within the 15 second requirement.
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT_MAX = 3
+RELAY_BUFFER_SIZE = 64 * 1024
+
+# Device priority classes, as set in the server's device configuration.
+PRIORITY_REALTIME = "realtime"  # Latency sensitive, e.g. Zigbee or Z-Wave coordinators.
+PRIORITY_NORMAL = "normal"
+PRIORITY_BULK = "bulk"  # Throughput bound, e.g. webcams or storage.
+PRIORITIES = (PRIORITY_REALTIME, PRIORITY_NORMAL, PRIORITY_BULK)
+# Priority class -> (OpenSSH IPQoS value, IP TOS byte).
+_QOS = {
+    PRIORITY_REALTIME: ("lowdelay", 0x10),
+    PRIORITY_NORMAL: ("lowdelay throughput", None),
+    PRIORITY_BULK: ("throughput", 0x08),
+}
+
+
+class TunnelError(Exception):
+    """Raised when a tunnel cannot be established or its forwards cannot be opened."""
+
+
+async def probe_local_port(local_port: int, timeout: float = 3.0) -> bool:
+    """Checks whether something accepts TCP connections on a local port."""
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection("127.0.0.1", local_port),
+            timeout=timeout
+        )
+        writer.close()
+        await writer.wait_closed()
+        return True
+    except (ConnectionRefusedError, asyncio.TimeoutError):
+        return False
+    except Exception as e:
+        logging.debug(f"Probe of local port {local_port} failed with unexpected error: {e}")
+        return False
+
+
+def tune_socket(sock, priority: str = PRIORITY_NORMAL):
+    """Disables Nagle's algorithm and marks the socket's traffic with the priority's TOS."""
+    if sock is None:
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    tos = _QOS.get(priority, _QOS[PRIORITY_NORMAL])[1]
+    if tos is not None and sock.family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, tos)
+
+
+class Transport(abc.ABC):
+    """Base class for a connection to a server that forwards local ports to remote ones."""
+
+    def __init__(
+        self,
+        name: str,
+        address: str,
+        ssh_port: int,
+        user: str,
+        key_path: str,
+        forwards: list,
+        ciphers: list | None = None,
+        priority: str = PRIORITY_NORMAL,
+    ):
+        self.name = name
+        self.address = address
+        self.ssh_port = ssh_port
+        self.user = user
+        self.key_path = key_path
+        # List of (local_port, remote_port) pairs; remote ports are on the server's localhost.
+        self.forwards = forwards
+        # Ciphers to try first, or None for the implementation's defaults. They are put in
+        # front of the defaults rather than replacing them, so servers without them still connect.
+        self.ciphers = ciphers
+        # Priority class of the traffic carried, which sets its TOS marking.
+        self.priority = priority
+        self.connected_at = None
+        # Byte counters, for transports that see the payload (None otherwise).
+        self.bytes_sent = None
+        self.bytes_received = None
+
+    def get_status(self) -> dict:
+        """Returns the transport's settings and, where measurable, its average throughput."""
+        status = {"cipher_preference": self.ciphers, "priority": self.priority}
+        if self.bytes_sent is not None and self.connected_at is not None:
+            elapsed = max(time.monotonic() - self.connected_at, 1e-6)
+            status["bytes_sent"] = self.bytes_sent
+            status["bytes_received"] = self.bytes_received
+            status["avg_send_bytes_per_s"] = self.bytes_sent / elapsed
+            status["avg_receive_bytes_per_s"] = self.bytes_received / elapsed
+        return status
+
+    @property
+    @abc.abstractmethod
+    def is_open(self) -> bool:
+        """Whether the connection is up."""
+
+    @abc.abstractmethod
+    async def start(self):
+        """Connects and returns once every forward is usable. Raises TunnelError otherwise."""
+
+    @abc.abstractmethod
+    async def wait_closed(self):
+        """Returns when the connection has gone away."""
+
+    @abc.abstractmethod
+    def close(self):
+        """Tears the connection down. Safe to call more than once."""
+
+    async def aclose(self):
+        """Tears the connection down and returns once its local ports are free to bind again."""
+        self.close()
+        await self.wait_closed()
+
+
+class OpenSSHTransport(Transport):
+    """Runs one 'ssh -N -L ...' subprocess per server."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.process = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def _build_command(self) -> list:
+        cmd = ["ssh", "-p", str(self.ssh_port), "-i", self.key_path]
+        if self.ciphers:
+            # A leading '^' puts the list at the head of OpenSSH's default set.
+            cmd += ["-c", "^" + ",".join(self.ciphers)]
+        for local_port, remote_port in self.forwards:
+            cmd += ["-L", f"{local_port}:localhost:{remote_port}"]
+        cmd += [
+            f"{self.user}@{self.address}",
+            "-N",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "ExitOnForwardFailure=yes",
+            "-o", f"ServerAliveInterval={KEEPALIVE_INTERVAL}",
+            "-o", f"ServerAliveCountMax={KEEPALIVE_COUNT_MAX}",
+            # USB/IP payloads are small and latency bound: no compression, low-delay TOS.
+            "-o", "Compression=no",
+            "-o", f"IPQoS={_QOS.get(self.priority, _QOS[PRIORITY_NORMAL])[0]}",
+        ]
+        return cmd
+
+    async def start(self):
+        SUBPROCESS_SPAWNS.inc(command="ssh")
+        self.process = await asyncio.create_subprocess_exec(*self._build_command())
+        local_port = self.forwards[0][0]
+        logging.info(f"[{self.name}] SSH tunnel process started on local port {local_port}.")
+
+        # The subprocess gives no readiness signal, so wait for the local port to respond.
+        for _ in range(CONNECT_TIMEOUT):
+            if not self.is_open:
+                raise TunnelError(f"ssh exited with code {self.process.returncode}")
+            if await probe_local_port(local_port):
+                self.connected_at = time.monotonic()
+                return
+            await asyncio.sleep(1)
+        self.close()
+        raise TunnelError("tunnel did not become responsive in time")
+
+    async def wait_closed(self):
+        if self.process is not None:
+            await self.process.wait()
+
+    def close(self):
+        if self.is_open:
+            self.process.terminate()
+
+    async def aclose(self):
+        # The ssh process holds the forwarded ports until it has exited, not just been signalled.
+        self.close()
+        if self.process is None:
+            return
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"[{self.name}] ssh did not exit within {CLOSE_TIMEOUT}s of SIGTERM. Killing it.")
+            self.process.kill()
+            await self.process.wait()
+
+
+class AsyncSSHTransport(Transport):
+    """Runs the SSH connection in-process with asyncssh and opens forwarded channels directly."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.conn = None
+        self.listeners = []
+        self._watch_task = None
+        self._closed = asyncio.Event()
+
+    @property
+    def is_open(self) -> bool:
+        return self.conn is not None and not self._closed.is_set()
+
+    async def start(self):
+        options = {}
+        if self.ciphers:
+            defaults = [alg.decode() for alg in asyncssh.encryption.get_default_encryption_algs()]
+            options["encryption_algs"] = list(dict.fromkeys(self.ciphers + defaults))
+        try:
+            self.conn = await asyncio.wait_for(
+                asyncssh.connect(
+                    self.address,
+                    port=self.ssh_port,
+                    username=self.user,
+                    client_keys=[self.key_path],
+                    known_hosts=None,  # Same trust model as StrictHostKeyChecking=no.
+                    keepalive_interval=KEEPALIVE_INTERVAL,
+                    keepalive_count_max=KEEPALIVE_COUNT_MAX,
+                    compression_algs=None,
+                    **options,
+                ),
+                timeout=CONNECT_TIMEOUT,
+            )
+            tune_socket(self.conn.get_extra_info("socket"), self.priority)
+            self._watch_task = asyncio.create_task(self._watch_connection(self.conn))
+            for local_port, remote_port in self.forwards:
+                # Open a channel up front: success proves the server can reach the remote port.
+                reader, writer = await self.conn.open_connection("localhost", remote_port)
+                writer.close()
+                listener = await self.conn.forward_local_port("127.0.0.1", local_port, "localhost", remote_port)
+                self.listeners.append(listener)
+        except (OSError, asyncio.TimeoutError, asyncssh.Error) as e:
+            self.close()
+            raise TunnelError(str(e) or repr(e)) from e
+        self.connected_at = time.monotonic()
+        logging.info(f"[{self.name}] In-process SSH connection established, forwarding local port {self.forwards[0][0]}.")
+
+    async def _watch_connection(self, conn):
+        try:
+            await conn.wait_closed()
+        finally:
+            self._closed.set()
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    def close(self):
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
+        if self.conn is not None:
+            self.conn.close()
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        self._closed.set()
+
+
+class DirectTransport(Transport):
+    """Relays the local ports straight to the server over plain TCP, without SSH.
+
+    Only meant for trusted networks where the server exposes usbipd and its web UI
+    directly. Counts the relayed bytes, so throughput can be reported per server.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._listeners = []
+        self._writers = set()
+        self._closed = asyncio.Event()
+
+    @property
+    def is_open(self) -> bool:
+        return bool(self._listeners) and not self._closed.is_set()
+
+    def _remote_endpoint(self, remote_port: int) -> tuple[str, int]:
+        return self.address, remote_port
+
+    async def _open_remote(self, remote_port: int):
+        host, port = self._remote_endpoint(remote_port)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=CONNECT_TIMEOUT)
+        tune_socket(writer.get_extra_info("socket"), self.priority)
+        return reader, writer
+
+    async def _pipe(self, reader, writer, direction: str):
+        try:
+            while data := await reader.read(RELAY_BUFFER_SIZE):
+                if direction == "sent":
+                    self.bytes_sent += len(data)
+                else:
+                    self.bytes_received += len(data)
+                TUNNEL_BYTES.inc(len(data), server=self.name, direction=direction)
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def _handler(self, remote_port: int):
+        async def handle(reader, writer):
+            tune_socket(writer.get_extra_info("socket"), self.priority)
+            try:
+                remote_reader, remote_writer = await self._open_remote(remote_port)
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.debug(f"[{self.name}] Direct connection to port {remote_port} failed: {e!r}")
+                writer.close()
+                return
+            if self._closed.is_set():
+                # Closed while connecting: close() has already run and would miss this pair.
+                writer.close()
+                remote_writer.close()
+                return
+            self._writers.update((writer, remote_writer))
+            await asyncio.gather(
+                self._pipe(reader, remote_writer, "sent"),
+                self._pipe(remote_reader, writer, "received"),
+            )
+            self._writers.difference_update((writer, remote_writer))
+        return handle
+
+    async def start(self):
+        try:
+            for local_port, remote_port in self.forwards:
+                # Connect once up front: success proves the server's port is reachable.
+                _, writer = await self._open_remote(remote_port)
+                writer.close()
+                listener = await asyncio.start_server(
+                    self._handler(remote_port), "127.0.0.1", local_port, reuse_address=True
+                )
+                self._listeners.append(listener)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.close()
+            raise TunnelError(str(e) or repr(e)) from e
+        self.connected_at = time.monotonic()
+        logging.info(f"[{self.name}] Direct LAN connection to {self.address} ready, no SSH encryption.")
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    def close(self):
+        for listener in self._listeners:
+            listener.close()
+        for writer in list(self._writers):
+            writer.close()
+        self._closed.set()
+
+
+def resolve_backend(backend: str) -> str:
+    """Maps the configured backend to the one that will actually be used."""
+    if backend == BACKEND_ASYNCSSH and asyncssh is None:
+        logging.warning("asyncssh is not installed. Falling back to the OpenSSH subprocess backend.")
+        return BACKEND_OPENSSH
+    if backend == BACKEND_AUTO:
+        return BACKEND_ASYNCSSH if asyncssh is not None else BACKEND_OPENSSH
+    return backend
+
+
+def create_transport(backend: str, *args, **kwargs) -> Transport:
+    """Creates a transport for an already resolved backend name."""
+    if backend == BACKEND_DIRECT:
+        return DirectTransport(*args, **kwargs)
+    if backend == BACKEND_ASYNCSSH:
+        return AsyncSSHTransport(*args, **kwargs)
+    return OpenSSHTransport(*args, **kwargs)
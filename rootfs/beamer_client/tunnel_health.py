@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import random
+import time
+
+from metrics import HEALTH_CHECK_FAILURES, HEALTH_CHECK_RTT_SECONDS
+from profiling import span
+from usbip_protocol import USBIPProtocolError, list_remote_devices
+
+# Probe scheduling. The worst case detection time is
+# MAX_PROBE_INTERVAL + PROBE_TIMEOUT + (FAILURE_THRESHOLD - 1) * (MIN_PROBE_INTERVAL + PROBE_TIMEOUT),
+# which stays well inside the 15 second requirement.
+MIN_PROBE_INTERVAL = 1.0
+MAX_PROBE_INTERVAL = 6.0
+PROBE_TIMEOUT = 3.0
+FAILURE_THRESHOLD = 2  # Consecutive failed probes before the tunnel is declared dead.
+STABLE_PROBES_TO_RELAX = 3  # Healthy probes in a row before the interval is stretched.
+DEGRADED_RTT_FACTOR = 3.0  # RTT this many times the baseline counts as degraded.
+RTT_EWMA_WEIGHT = 0.2
+
+# Reconnect backoff.
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+RECONNECT_RESET_AFTER = 60.0  # A connection that lived this long resets the backoff.
+
+
+class TunnelHealthMonitor:
+    """Probes a tunnel end to end with a USB/IP device list request and adapts the probe rate."""
+
+    def __init__(self, name: str, local_port: int):
+        self.name = name
+        self.local_port = local_port
+        self.interval = MIN_PROBE_INTERVAL
+        self.last_rtt = None
+        self.smoothed_rtt = None
+        self.baseline_rtt = None
+        # Devices listed by the last successful probe
+        self.devices = None
+        self._failures = 0
+        self._stable_probes = 0
+
+    async def _probe(self) -> float | None:
+        """Returns the round trip time of one device list exchange, or None if it failed."""
+        started = time.monotonic()
+        try:
+            with span("health_check", server=self.name):
+                self.devices = await list_remote_devices("127.0.0.1", self.local_port, timeout=PROBE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, USBIPProtocolError) as e:
+            logging.debug(f"[{self.name}] Health probe failed: {e!r}")
+            return None
+        return time.monotonic() - started
+
+    def _record_rtt(self, rtt: float):
+        self.last_rtt = rtt
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+        else:
+            self.smoothed_rtt += RTT_EWMA_WEIGHT * (rtt - self.smoothed_rtt)
+        if self.baseline_rtt is None or rtt < self.baseline_rtt:
+            self.baseline_rtt = rtt
+
+    async def check(self) -> bool:
+        """Runs one probe and returns False once the tunnel should be considered dead."""
+        rtt = await self._probe()
+        if rtt is None:
+            HEALTH_CHECK_FAILURES.inc(server=self.name)
+            self._failures += 1
+            self._stable_probes = 0
+            self.interval = MIN_PROBE_INTERVAL
+            return self._failures < FAILURE_THRESHOLD
+
+        self._failures = 0
+        HEALTH_CHECK_RTT_SECONDS.observe(rtt, server=self.name)
+        self._record_rtt(rtt)
+        if rtt > max(self.baseline_rtt * DEGRADED_RTT_FACTOR, 0.05):
+            # Link is slowing down: watch it closely.
+            if self.interval > MIN_PROBE_INTERVAL:
+                logging.info(
+                    f"[{self.name}] Tunnel RTT degraded to {rtt * 1000:.0f} ms "
+                    f"(baseline {self.baseline_rtt * 1000:.0f} ms). Probing more often."
+                )
+            self._stable_probes = 0
+            self.interval = MIN_PROBE_INTERVAL
+        else:
+            self._stable_probes += 1
+            if self._stable_probes >= STABLE_PROBES_TO_RELAX:
+                self.interval = min(MAX_PROBE_INTERVAL, self.interval * 2)
+        logging.debug(f"[{self.name}] Health probe RTT {rtt * 1000:.1f} ms, next in {self.interval:.1f}s.")
+        return True
+
+
+class ReconnectBackoff:
+    """Capped exponential backoff with jitter for tunnel reconnects."""
+
+    def __init__(self):
+        self._attempts = 0
+        self._connected_at = None
+
+    def connected(self):
+        self._connected_at = time.monotonic()
+
+    def next_delay(self) -> float:
+        """Returns how long to wait before the next reconnect attempt."""
+        if self._connected_at is not None and time.monotonic() - self._connected_at >= RECONNECT_RESET_AFTER:
+            self._attempts = 0
+        self._connected_at = None
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** self._attempts)
+        self._attempts += 1
+        return delay * random.uniform(0.8, 1.2)
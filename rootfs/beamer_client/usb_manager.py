@@ -1,78 +1,577 @@
 import asyncio
 import logging
-import re
-import subprocess
+import time
 import aiohttp
-import json
+
+from attach_scheduler import DEFAULT_ATTACH_CONCURRENCY, AttachScheduler
+from metrics import (
+    ATTACH_SECONDS,
+    DETACH_SECONDS,
+    DEVICE_FAILURES,
+    DEVICE_RECOVERY_SECONDS,
+    SUBPROCESS_SPAWNS,
+    SYNC_DURATION_SECONDS,
+)
+from profiling import span
+from transport import PRIORITIES, PRIORITY_NORMAL
+from usbip_protocol import USBIPProtocolError, list_remote_devices
+from vhci import VHCI
+
+EXPORTED_DEVICES_PATH = "/api/exported-devices"
+# Combined endpoint returning the desired and the exportable devices plus a config version in one reply.
+SYNC_STATE_PATH = "/api/sync-state"
+SYNC_DIFF_KEYS = ("desired_added", "desired_removed", "available_added", "available_removed")
+CONFIG_VERSION_HEADER = "X-Config-Version"
+HTTP_KEEPALIVE_TIMEOUT = 60  # Seconds an idle pooled API connection is kept open.
+# Which devices get a connection of their own instead of sharing the server's tunnel.
+DEVICE_ISOLATION_PRIORITY = "priority"  # Devices with a realtime or bulk priority class.
+DEVICE_ISOLATION_ALL = "all"  # Every device.
+DEVICE_ISOLATION_MODES = (DEVICE_ISOLATION_PRIORITY, DEVICE_ISOLATION_ALL)
+
+
+def _parse_busids(data) -> set:
+    """Returns the bus IDs from a list of bus IDs and/or {"busid"} objects."""
+    busids = set()
+    for entry in data or ():
+        busid = entry.get("busid") if isinstance(entry, dict) else entry
+        if busid:
+            busids.add(str(busid))
+    return busids
+
+
+def _parse_desired_devices(data) -> dict:
+    """Returns {busid: priority} from the exported devices API reply.
+
+    Accepts a plain list of bus IDs, a list mixing bus IDs and {"busid", "priority"}
+    objects, or an object mapping bus IDs to {"priority"}.
+    """
+    if isinstance(data, dict):
+        data = [{"busid": busid, **(entry if isinstance(entry, dict) else {})} for busid, entry in data.items()]
+    devices = {}
+    for entry in data:
+        if isinstance(entry, dict):
+            busid, priority = entry.get("busid"), entry.get("priority", PRIORITY_NORMAL)
+        else:
+            busid, priority = entry, PRIORITY_NORMAL
+        if not busid:
+            continue
+        devices[str(busid)] = priority if priority in PRIORITIES else PRIORITY_NORMAL
+    return devices
+
+
+def _is_sync_state(data, have_base: bool) -> bool:
+    """Tells whether a combined sync reply is sync state at all, rather than some other JSON.
+
+    Full state needs a "desired" entry. A diff, or "unchanged", is only accepted when
+    one was asked for.
+    """
+    if not isinstance(data, dict):
+        return False
+    if "desired" in data:
+        return True
+    return have_base and (bool(data.get("unchanged")) or any(key in data for key in SYNC_DIFF_KEYS))
+
 
 class USBManager:
     """Manages attaching and detaching USB/IP devices through active SSH tunnels."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        attach_concurrency: int = DEFAULT_ATTACH_CONCURRENCY,
+        vhci: VHCI | None = None,
+        device_isolation: str = DEVICE_ISOLATION_PRIORITY,
+    ):
         # Maps a server name (e.g., 'beamer-server') to a SET of its attached bus IDs
         self.attached_devices_by_server = {}
+        # Maps a server name to {busid: USBDevice} from its last device list reply
+        self.remote_devices_by_server = {}
+        # Maps a server name to the SET of bus IDs its API last asked us to attach
+        self.desired_devices_by_server = {}
+        # Server names that currently push configuration changes to us
+        self.push_enabled_servers = set()
+        # Maps a server name to its long-lived aiohttp.ClientSession
+        self._http_sessions = {}
+        # Maps a server name to the ETag or config version of its last API reply
+        self._desired_versions = {}
+        # Maps a server name to whether it serves the combined sync endpoint (absent: not known yet)
+        self._combined_sync = {}
+        # Maps a server name to the config version of its last combined sync reply
+        self._sync_versions = {}
+        # Maps a server name to the SET of bus IDs it can currently export, from the combined endpoint
+        self.available_devices_by_server = {}
+        # Maps a server name to the monotonic time its tunnel (re)connected
+        self._reconnected_at = {}
+        self.attach_scheduler = AttachScheduler(self._attach_busid, attach_concurrency)
+        # Maps a local usbip port back to the server it belongs to, for metric labels
+        self._servers_by_local_port = {}
+        # Maps a server name to the local usbip port its devices were attached through
+        self.local_ports_by_server = {}
+        self.vhci = vhci or VHCI()
+        # Detach requests waiting for the next batched pass over vhci state
+        self._pending_detaches = {}
+        self._detach_flush = None
+        # Maps a server name to {busid: priority class} from its device configuration
+        self.device_priorities_by_server = {}
+        # Maps a server name to {busid: local port} for devices attached over their own channel
+        self.device_ports_by_server = {}
+        self.device_isolation = device_isolation
+        # Set by the tunnel owner: async channel_opener(server_name, busid, priority) returns
+        # the local port of a dedicated connection for one device, or None if none could be
+        # opened; async channel_closer(server_name, busid) releases it again.
+        self.channel_opener = None
+        self.channel_closer = None
+        # Maps a server name to the SET of bus IDs the watchdog is reattaching right now
+        self._repairing = {}
+        # Maps (server name, busid) to the monotonic time the watchdog found it broken
+        self._failed_at = {}
+        # Maps (server name, busid) to [recoveries, total seconds to recover]
+        self._recovery_stats = {}
+
+    async def reconcile_after_reconnect(self, server_name: str):
+        """Drops the devices whose USB/IP connection ended with a tunnel outage.
+
+        Devices whose vhci port is gone or in an error state are dropped from the
+        attached set (releasing the port if needed), so the next sync re-imports
+        them. Imports made through the tunnel's forwards never survive it.
+        """
+        attached = self.attached_devices_by_server.get(server_name, set())
+        if not attached:
+            return
+        alive = set()
+        broken_ports = set()
+        for port in await self._get_device_ports(server_name, attached):
+            if port.is_error:
+                broken_ports.add(port.port)
+            else:
+                alive.add(port.remote_busid)
+
+        broken = attached - alive
+        if broken_ports:
+            await self.vhci.detach_ports(broken_ports)
+        self.attached_devices_by_server[server_name] = alive
+        if broken:
+            logging.info(f"[{server_name}] Devices kept across reconnect: {alive or 'none'}. Re-importing: {broken}")
+        else:
+            logging.info(f"[{server_name}] All {len(alive)} device(s) survived the reconnect.")
+
+    async def check_attached_devices(self, server_name: str, local_port: int):
+        """Watchdog pass: finds attached devices whose vhci port failed and reattaches only those.
+
+        A device counts as failed when its vhci port is in an error state or gone, which
+        is what the kernel does once the device's USB/IP connection breaks. The tunnel
+        and the other devices of the server are left alone.
+        """
+        checked = set(self.attached_devices_by_server.get(server_name, set()))
+        if not checked:
+            return
+        healthy = set()
+        error_ports = {}
+        for port in await self._get_device_ports(server_name, checked):
+            if port.is_error:
+                error_ports[port.port] = port.remote_busid
+            else:
+                healthy.add(port.remote_busid)
+
+        # Skip devices detached or repaired while vhci was read, and those no longer wanted.
+        attached = self.attached_devices_by_server.get(server_name, set())
+        failed = (checked & attached & self.desired_devices_by_server.get(server_name, set())) - healthy
+        failed -= self._repairing.get(server_name, set())
+        if not failed:
+            return
 
-    async def _get_desired_busids(self, server_name: str, local_http_port: int) -> set | None:
-        """Gets the desired set of bus IDs from the server's configuration API."""
-        url = f"http://127.0.0.1:{local_http_port}/api/exported-devices"
+        now = time.monotonic()
+        for busid in sorted(failed):
+            logging.warning(
+                f"[{server_name}] Device {busid} lost its vhci port or went into an error state. Reattaching."
+            )
+            DEVICE_FAILURES.inc(server=server_name, busid=busid)
+            self._failed_at.setdefault((server_name, busid), now)
+        # Claim the devices before the first await, so a sync running meanwhile does not import them too.
+        repairing = self._repairing.setdefault(server_name, set())
+        repairing |= failed
+        attached -= failed
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=5) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return set(data)
+            await self.vhci.detach_ports({port for port, busid in error_ports.items() if busid in failed})
+            device_ports = await self._open_device_channels(server_name, failed)
+            reattached = await self.attach_scheduler.attach_all(server_name, local_port, failed, device_ports)
+            self.attached_devices_by_server.setdefault(server_name, set()).update(reattached)
+            self._record_recoveries(server_name, reattached)
+        finally:
+            repairing -= failed
+
+    def _record_recoveries(self, server_name: str, busids: set):
+        """Records the time to recovery of devices the watchdog had found broken."""
+        now = time.monotonic()
+        for busid in busids:
+            failed_at = self._failed_at.pop((server_name, busid), None)
+            if failed_at is None:
+                continue
+            elapsed = now - failed_at
+            DEVICE_RECOVERY_SECONDS.observe(elapsed, server=server_name, busid=busid)
+            stats = self._recovery_stats.setdefault((server_name, busid), [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            logging.info(f"[{server_name}] Device {busid} recovered after {elapsed:.2f}s.")
+
+    def _expected_port(self, server_name: str, busid: str) -> int | None:
+        """Returns the local port a device of a server is attached through."""
+        port = self.device_ports_by_server.get(server_name, {}).get(busid)
+        return port if port is not None else self.local_ports_by_server.get(server_name)
+
+    async def _get_device_ports(self, server_name: str, busids: set) -> list:
+        """Returns the in-use vhci ports holding the given devices of a server.
+
+        Bus IDs are only unique per server, so a port only counts if it was imported
+        through the local port the device is expected on.
+        """
+        return [
+            port for port in await self.vhci.get_ports()
+            if port.in_use
+            and port.remote_busid in busids
+            and port.remote_port == self._expected_port(server_name, port.remote_busid)
+        ]
+
+    def _wants_own_channel(self, server_name: str, busid: str) -> bool:
+        if self.channel_opener is None:
+            return False
+        if self.device_isolation == DEVICE_ISOLATION_ALL:
+            return True
+        return self.device_priorities_by_server.get(server_name, {}).get(busid, PRIORITY_NORMAL) != PRIORITY_NORMAL
+
+    async def _open_device_channels(self, server_name: str, busids: set) -> dict:
+        """Opens dedicated connections for the devices that should not share the tunnel.
+
+        Returns {busid: local port} for those that got one. Devices whose channel could
+        not be opened fall back to the shared tunnel.
+        """
+        priorities = self.device_priorities_by_server.get(server_name, {})
+        wanted = sorted(busid for busid in busids if self._wants_own_channel(server_name, busid))
+        if not wanted:
+            return {}
+        openers = [
+            asyncio.ensure_future(self.channel_opener(server_name, busid, priorities.get(busid, PRIORITY_NORMAL)))
+            for busid in wanted
+        ]
+        try:
+            ports = await asyncio.gather(*openers, return_exceptions=True)
+            error = next((port for port in ports if isinstance(port, BaseException)), None)
+            if error is not None:
+                raise error
+        except BaseException:
+            # An opener failed or the sync was cancelled. Close the channels that did open,
+            # which nothing would track otherwise.
+            device_ports = self.device_ports_by_server.setdefault(server_name, {})
+            for busid, opener in zip(wanted, openers):
+                if opener.done() and not opener.cancelled() and opener.exception() is None and opener.result():
+                    device_ports[busid] = opener.result()
+            await self._close_device_channels(server_name, set(wanted))
+            raise
+        opened = {}
+        for busid, port in zip(wanted, ports):
+            if port is None:
+                logging.warning(f"[{server_name}] No dedicated channel for {busid}. Using the shared tunnel.")
+                continue
+            opened[busid] = port
+            self._servers_by_local_port[port] = server_name
+        self.device_ports_by_server.setdefault(server_name, {}).update(opened)
+        return opened
+
+    async def _close_device_channels(self, server_name: str, busids: set):
+        """Releases the dedicated connections of devices that were detached."""
+        ports = self.device_ports_by_server.get(server_name, {})
+        for busid in busids & ports.keys():
+            self._servers_by_local_port.pop(ports.pop(busid), None)
+            if self.channel_closer is not None:
+                await self.channel_closer(server_name, busid)
+        if not ports:
+            self.device_ports_by_server.pop(server_name, None)
+
+    def mark_reconnect(self, server_name: str):
+        """Records that a server's tunnel just came up, to time how long it takes to reattach."""
+        self._reconnected_at[server_name] = time.monotonic()
+        self.attach_scheduler.forget_server(server_name)
+
+    def next_retry_delay(self, server_name: str) -> float | None:
+        """Returns the seconds until the next backed-off attach of a server may be retried."""
+        return self.attach_scheduler.next_retry_delay(server_name)
+
+    def _get_http_session(self, server_name: str) -> aiohttp.ClientSession:
+        """Returns the pooled keep-alive HTTP session for a server, creating it if needed."""
+        session = self._http_sessions.get(server_name)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+            session = aiohttp.ClientSession(connector=connector)
+            self._http_sessions[server_name] = session
+        return session
+
+    def record_remote_devices(self, server_name: str, devices: list):
+        """Stores the device records from a server's latest USB/IP device list reply."""
+        self.remote_devices_by_server[server_name] = {device.busid: device for device in devices}
+
+    async def close_server_session(self, server_name: str):
+        """Closes the pooled HTTP session of a server, e.g. when its tunnel goes down."""
+        self._desired_versions.pop(server_name, None)
+        # The server may have been upgraded or replaced while we were disconnected.
+        self._combined_sync.pop(server_name, None)
+        self._sync_versions.pop(server_name, None)
+        session = self._http_sessions.pop(server_name, None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def get_status(self) -> dict:
+        """Returns a JSON-serialisable snapshot of the per-server device state."""
+        return {
+            server_name: {
+                "attached": sorted(self.attached_devices_by_server.get(server_name, set())),
+                "desired": sorted(self.desired_devices_by_server.get(server_name, set())),
+                "remote_devices": {
+                    busid: {
+                        "usb_id": device.usb_id,
+                        "speed": device.speed,
+                        "device_class": device.device_class,
+                        "interfaces": [
+                            [interface.interface_class, interface.interface_subclass, interface.interface_protocol]
+                            for interface in device.interfaces
+                        ],
+                    }
+                    for busid, device in self.remote_devices_by_server.get(server_name, {}).items()
+                },
+                "push_enabled": server_name in self.push_enabled_servers,
+                "priorities": self.device_priorities_by_server.get(server_name, {}),
+                "device_channels": self.device_ports_by_server.get(server_name, {}),
+                "recoveries": {
+                    busid: {"count": count, "mean_time_to_recovery_s": total / count}
+                    for (name, busid), (count, total) in self._recovery_stats.items()
+                    if name == server_name
+                },
+            }
+            for server_name in self.attached_devices_by_server.keys() | self.desired_devices_by_server.keys()
+        }
+
+    async def close(self):
+        """Closes all pooled HTTP sessions."""
+        for server_name in list(self._http_sessions):
+            await self.close_server_session(server_name)
+
+    def _unattached_busids(self, server_name: str) -> set:
+        """Returns the desired bus IDs that are neither attached nor being repaired by the watchdog."""
+        return (
+            self.desired_devices_by_server.get(server_name, set())
+            - self.attached_devices_by_server.get(server_name, set())
+            - self._repairing.get(server_name, set())
+        )
+
+    def _known_available_busids(self, server_name: str) -> set | None:
+        """Returns the bus IDs the server last said it can export, or None if it never said."""
+        if server_name in self.available_devices_by_server:
+            return self.available_devices_by_server[server_name]
+        if server_name in self.remote_devices_by_server:
+            return set(self.remote_devices_by_server[server_name])
+        return None
+
+    def has_pending_attaches(self, server_name: str) -> bool:
+        """Returns True if the server wants devices that could be attached now but are not yet.
+
+        Devices the server did not offer at the last look and devices whose attach is
+        backing off do not count; a change push or the retry timer brings those back.
+        """
+        pending = self._unattached_busids(server_name)
+        available = self._known_available_busids(server_name)
+        if available is not None:
+            pending &= available
+        return any(not self.attach_scheduler.is_backing_off(server_name, busid) for busid in pending)
+
+    async def watch_exported_devices(self, server_name: str, local_http_port: int, on_change) -> bool:
+        """Subscribes to the server's device configuration change stream.
+
+        Requests the exported devices endpoint as a Server-Sent Events stream and calls
+        on_change() for every event received. Returns False straight away if the server
+        does not support streaming; otherwise returns once the stream ends.
+        """
+        url = f"http://127.0.0.1:{local_http_port}{EXPORTED_DEVICES_PATH}"
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=None)
+        session = self._get_http_session(server_name)
+        async with session.get(url, headers={"Accept": "text/event-stream"}, timeout=timeout) as response:
+            if response.status != 200 or response.content_type != "text/event-stream":
+                # Older servers ignore the Accept header and answer with plain JSON.
+                logging.info(
+                    f"[{server_name}] Server does not push device changes "
+                    f"(status {response.status}, {response.content_type}). Using polling."
+                )
+                return False
+
+            logging.info(f"[{server_name}] Subscribed to device configuration changes.")
+            self.push_enabled_servers.add(server_name)
+            try:
+                # Anything may have changed between our last sync and the subscription.
+                on_change()
+                pending_event = False
+                async for raw_line in response.content:
+                    line = raw_line.decode(errors="replace").strip()
+                    if not line:
+                        # A blank line terminates an event.
+                        if pending_event:
+                            logging.debug(f"[{server_name}] Device configuration change pushed.")
+                            on_change()
+                        pending_event = False
+                    elif not line.startswith(":"):
+                        # Lines starting with ':' are keep-alive comments.
+                        pending_event = True
+            finally:
+                self.push_enabled_servers.discard(server_name)
+        return True
+
+    async def _get_desired_busids(self, server_name: str, local_http_port: int) -> tuple[set, bool] | None:
+        """Gets the desired set of bus IDs from the server's configuration API.
+
+        Returns the bus IDs together with a flag telling whether the configuration
+        changed since the previous call, or None on error. Unchanged configurations
+        are detected through ETag/If-None-Match or the server's config version header.
+        """
+        url = f"http://127.0.0.1:{local_http_port}{EXPORTED_DEVICES_PATH}"
+        previous_version = self._desired_versions.get(server_name)
+        headers = {}
+        if previous_version is not None and server_name in self.desired_devices_by_server:
+            headers["If-None-Match"] = previous_version
+        try:
+            session = self._get_http_session(server_name)
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                if response.status == 304:
+                    return self.desired_devices_by_server[server_name], False
+                elif response.status == 200:
+                    devices = _parse_desired_devices(await response.json())
+                    version = response.headers.get("ETag") or response.headers.get(CONFIG_VERSION_HEADER)
+                    if version is not None:
+                        self._desired_versions[server_name] = version
                     else:
-                        logging.warning(
-                            f"[{server_name}] Failed to get desired devices from API. "
-                            f"Status: {response.status}"
-                        )
-                        return None
+                        self._desired_versions.pop(server_name, None)
+                    unchanged = (
+                        version is not None
+                        and version == previous_version
+                        and server_name in self.desired_devices_by_server
+                    )
+                    self.device_priorities_by_server[server_name] = devices
+                    return set(devices), not unchanged
+                else:
+                    logging.warning(
+                        f"[{server_name}] Failed to get desired devices from API. "
+                        f"Status: {response.status}"
+                    )
+                    return None
         except Exception as e:
             logging.error(f"[{server_name}] Error connecting to device configuration API: {e}")
             return None
 
-    async def _get_remote_busids(self, server_name: str, local_port: int) -> set | None:
-        """Lists devices from a server and returns a set of bus IDs, or None on error."""
-        list_cmd = ["usbip", f"--tcp-port={local_port}", "list", f"--remote=127.0.0.1"]
-        proc = await asyncio.create_subprocess_exec(
-            *list_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await proc.communicate()
+    async def _get_sync_state(self, server_name: str, local_http_port: int) -> tuple[set, set, bool] | None:
+        """Gets the desired and the exportable bus IDs in one request to the combined endpoint.
 
-        stdout_str = stdout.decode().strip()
-        stderr_str = stderr.decode().strip()
-        
-        # This log is very verbose, so it's now at DEBUG level.
-        logging.debug(f"[{server_name}] 'usbip list' stdout:\n---\n{stdout_str}\n---")
+        Asks for the changes since the config version of the previous reply, so an unchanged
+        server answers with a tiny "nothing changed" reply. Returns (desired, available,
+        changed), or None on error. Servers without the endpoint are remembered, and None
+        is returned so the caller falls back to the separate requests.
+        """
+        url = f"http://127.0.0.1:{local_http_port}{SYNC_STATE_PATH}"
+        since = self._sync_versions.get(server_name)
+        have_base = since is not None and server_name in self.available_devices_by_server
+        params = {"since": str(since)} if have_base else {}
+        try:
+            session = self._get_http_session(server_name)
+            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                if response.status in (404, 405, 501):
+                    logging.info(f"[{server_name}] Server has no combined sync endpoint. Using separate requests.")
+                    self._combined_sync[server_name] = False
+                    return None
+                if response.status == 304 and have_base:
+                    data = {"version": since, "unchanged": True}
+                elif response.status == 200:
+                    try:
+                        data = await response.json()
+                    except (aiohttp.ContentTypeError, ValueError):
+                        data = None
+                    if not _is_sync_state(data, have_base):
+                        # Something else answers on that path, e.g. a web UI catch-all route.
+                        logging.info(f"[{server_name}] Combined sync endpoint returned no sync state. Using separate requests.")
+                        self._combined_sync[server_name] = False
+                        return None
+                else:
+                    logging.warning(f"[{server_name}] Combined sync request failed. Status: {response.status}")
+                    return None
+        except Exception as e:
+            logging.error(f"[{server_name}] Error connecting to combined sync API: {e}")
+            return None
 
-        if proc.returncode != 0:
-            logging.error(f"[{server_name}] 'usbip list' command failed with code {proc.returncode}.")
-            if stderr_str:
-                logging.error(f"[{server_name}] 'usbip list' stderr:\n---\n{stderr_str}\n---")
+        desired = dict(self.device_priorities_by_server.get(server_name, {}))
+        available = set(self.available_devices_by_server.get(server_name, set()))
+        try:
+            if data.get("unchanged"):
+                changed = False
+            elif "desired" in data:
+                # Full state, also sent when the server cannot diff against our version.
+                if not isinstance(data["desired"], (list, dict)):
+                    raise TypeError(f"'desired' is {type(data['desired']).__name__}, not a list")
+                desired = _parse_desired_devices(data["desired"])
+                available = _parse_busids(data.get("available", []))
+                changed = True
+            else:
+                for busid in _parse_busids(data.get("desired_removed")):
+                    desired.pop(busid, None)
+                desired.update(_parse_desired_devices(data.get("desired_added", [])))
+                available -= _parse_busids(data.get("available_removed"))
+                available |= _parse_busids(data.get("available_added"))
+                changed = True
+        except (AttributeError, TypeError, ValueError) as e:
+            # Ask for the full state next time rather than diffing against a reply we could not apply.
+            logging.warning(f"[{server_name}] Invalid combined sync reply: {e!r}")
+            self._sync_versions.pop(server_name, None)
             return None
-        
-        if stderr_str:
-             # Don't log normal 'usbip info' messages as warnings.
-             if "error:" in stderr_str.lower() or "failed:" in stderr_str.lower():
-                 logging.warning(f"[{server_name}] 'usbip list' stderr contained warnings/errors:\n---\n{stderr_str}\n---")
-             else:
-                 logging.debug(f"[{server_name}] 'usbip list' stderr:\n---\n{stderr_str}\n---")
-        
-        # This regex now correctly parses output like: '      1-5.4: description'
-        # by finding bus IDs at the start of an indented line.
-        bus_ids = set(re.findall(r'^\s*([0-9a-zA-Z.-]+):', stdout_str, re.MULTILINE))
-        # This is also for debugging, so moved to DEBUG level.
-        logging.debug(f"[{server_name}] Parsed bus IDs: {bus_ids}")
-        return bus_ids
+        self._combined_sync[server_name] = True
+
+        if data.get("version") is not None:
+            self._sync_versions[server_name] = data["version"]
+        else:
+            self._sync_versions.pop(server_name, None)
+        self.device_priorities_by_server[server_name] = desired
+        self.available_devices_by_server[server_name] = available
+        if server_name not in self.desired_devices_by_server:
+            changed = True  # Nothing was applied from the previous replies yet.
+        return set(desired), available, changed
+
+    async def _get_remote_busids(self, server_name: str, local_port: int) -> set | None:
+        """Lists devices from a server and returns a set of bus IDs, or None on error."""
+        try:
+            devices = await list_remote_devices("127.0.0.1", local_port)
+        except USBIPProtocolError as e:
+            logging.error(f"[{server_name}] Invalid USB/IP device list reply: {e}")
+            return None
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.error(f"[{server_name}] Could not list remote USB/IP devices: {e!r}")
+            return None
+
+        self.record_remote_devices(server_name, devices)
+        for device in devices:
+            # This log is very verbose, so it's at DEBUG level.
+            logging.debug(
+                f"[{server_name}] Remote device {device.busid}: {device.usb_id}, "
+                f"speed={device.speed}, interfaces={len(device.interfaces)}"
+            )
+        return {device.busid for device in devices}
 
     async def _attach_busid(self, local_port: int, busid: str) -> bool:
         """Attaches a single device by its bus ID."""
         logging.info(f"Attaching device {busid} on port {local_port}...")
         attach_cmd = ["usbip", f"--tcp-port={local_port}", "attach", f"--remote=127.0.0.1", f"--busid={busid}"]
-        proc = await asyncio.create_subprocess_exec(
-            *attach_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        started = time.monotonic()
+        SUBPROCESS_SPAWNS.inc(command="usbip attach")
+        with span("attach", busid=busid, local_port=local_port):
+            proc = await asyncio.create_subprocess_exec(
+                *attach_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await proc.communicate()
+        ATTACH_SECONDS.observe(
+            time.monotonic() - started,
+            server=self._servers_by_local_port.get(local_port, ""),
+            result="success" if proc.returncode == 0 else "failure",
         )
-        stdout, stderr = await proc.communicate()
 
         if proc.returncode == 0:
             logging.info(f"Successfully attached {busid}.")
@@ -82,33 +581,90 @@ class USBManager:
             logging.error(f"Failed to attach {busid}. Stderr:\n---\n{stderr_str}\n---")
             return False
 
-    async def _detach_busids(self, busids_to_detach: set):
-        """Detaches a set of devices by finding their local port and using 'usbip detach'."""
+    async def _detach_busids(self, server_name: str, busids_to_detach: set):
+        """Detaches a set of a server's devices through vhci sysfs.
+
+        Requests issued in the same event loop iteration, e.g. by several tunnels
+        dropping at once, are coalesced into a single pass over the vhci state.
+        """
         if not busids_to_detach:
             return
-        
-        try:
-            result = subprocess.run(["usbip", "port"], capture_output=True, text=True, check=True)
-            busid_pattern = "|".join(re.escape(busid) for busid in busids_to_detach)
-            port_matches = re.findall(r"Port (\d+).*<Port in Use>.*(?:{})\b".format(busid_pattern), result.stdout)
-
-            for port_num in set(port_matches):
-                logging.info(f"Detaching device at local port {port_num} (busids: {busids_to_detach})...")
-                subprocess.run(["usbip", "detach", f"--port={port_num}"], check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error while detaching devices: {e.stderr}")
-        except Exception as e:
-            logging.error(f"An unexpected error occurred during detach: {e}")
+        self._pending_detaches.setdefault(server_name, set()).update(busids_to_detach)
+        if self._detach_flush is None:
+            self._detach_flush = asyncio.create_task(self._flush_detaches())
+        await asyncio.shield(self._detach_flush)
+
+    async def _flush_detaches(self):
+        # Yield once so that concurrent callers can join this batch.
+        await asyncio.sleep(0)
+        pending, self._pending_detaches = self._pending_detaches, {}
+        self._detach_flush = None
+        started = time.monotonic()
+        result = "failure"
+        with span("detach", servers=sorted(pending)):
+            try:
+                ports = await self.vhci.get_ports()
+                to_detach = {}
+                for server_name, busids in pending.items():
+                    for port in ports:
+                        if not port.in_use or port.remote_busid not in busids:
+                            continue
+                        # Bus IDs are only unique per server, so also match the tunnel port.
+                        expected_port = self._expected_port(server_name, port.remote_busid)
+                        if expected_port is not None and port.remote_port != expected_port:
+                            continue
+                        to_detach[port.port] = (server_name, port.remote_busid)
+
+                for port_number, (server_name, busid) in sorted(to_detach.items()):
+                    logging.info(f"[{server_name}] Detaching device {busid} at vhci port {port_number}...")
+                detached = await self.vhci.detach_ports(to_detach.keys())
+                if len(detached) != len(to_detach):
+                    logging.warning(f"Detached {len(detached)} of {len(to_detach)} vhci ports.")
+                else:
+                    result = "success"
+            except Exception as e:
+                logging.error(f"An unexpected error occurred during detach: {e}")
+            finally:
+                DETACH_SECONDS.observe(time.monotonic() - started, result=result)
 
     async def scan_and_sync_devices(self, server_name: str, local_port: int, local_http_port: int):
         """The main periodic function to keep client state in sync with the server."""
+        started = time.monotonic()
+        try:
+            with span("sync", server=server_name):
+                await self._sync_devices(server_name, local_port, local_http_port)
+        finally:
+            SYNC_DURATION_SECONDS.observe(time.monotonic() - started, server=server_name)
+
+    async def _sync_devices(self, server_name: str, local_port: int, local_http_port: int):
         logging.debug(f"[{server_name}] Running device sync...")
+        self.local_ports_by_server[server_name] = local_port
+        self._servers_by_local_port[local_port] = server_name
         
-        # Get the "desired state" from the server's API, which is the source of truth.
-        desired_busids = await self._get_desired_busids(server_name, local_http_port)
-        if desired_busids is None:
-            logging.warning(f"[{server_name}] Could not get desired device list from server API. Skipping sync.")
+        # Get the "desired state" from the server's API, which is the source of truth. Servers with
+        # the combined endpoint also report what they can export, saving the USB/IP device list.
+        available_busids = None
+        if self._combined_sync.get(server_name) is not False:
+            state = await self._get_sync_state(server_name, local_http_port)
+            if state is not None:
+                desired_busids, available_busids, changed = state
+            elif self._combined_sync.get(server_name) is not False:
+                logging.warning(f"[{server_name}] Could not get device state from server API. Skipping sync.")
+                return
+        if available_busids is None:
+            desired = await self._get_desired_busids(server_name, local_http_port)
+            if desired is None:
+                logging.warning(f"[{server_name}] Could not get desired device list from server API. Skipping sync.")
+                return
+            desired_busids, changed = desired
+            known_available = self._known_available_busids(server_name)
+            if not changed and self._unattached_busids(server_name) - (known_available or set()):
+                # Only a new device list tells whether the devices missing from the last one are back.
+                available_busids = await self._get_remote_busids(server_name, local_port)
+        if not changed and not self.has_pending_attaches(server_name):
+            logging.debug(f"[{server_name}] Device configuration unchanged and nothing attachable is missing. Nothing to do.")
             return
+        self.desired_devices_by_server[server_name] = desired_busids
 
         currently_attached = self.attached_devices_by_server.get(server_name, set())
         logging.debug(f"[{server_name}] Sync state: Desired={desired_busids}, Local={currently_attached}")
@@ -117,32 +673,62 @@ class USBManager:
         to_detach = currently_attached - desired_busids
         if to_detach:
             logging.info(f"[{server_name}] Server configuration changed. Detaching devices: {to_detach}")
-            await self._detach_busids(to_detach)
+            await self._detach_busids(server_name, to_detach)
             self.attached_devices_by_server[server_name] -= to_detach
+        # Release the channels of every device no longer wanted, including ones whose attach never succeeded.
+        unwanted_channels = self.device_ports_by_server.get(server_name, {}).keys() - desired_busids
+        if unwanted_channels:
+            await self._close_device_channels(server_name, unwanted_channels)
 
-        # Identify devices that are desired but not yet attached.
-        to_attach_candidates = desired_busids - currently_attached
+        # Identify devices that are desired but not yet attached, leaving those the watchdog is repairing.
+        to_attach_candidates = desired_busids - currently_attached - self._repairing.get(server_name, set())
         if to_attach_candidates:
             # Check which of the desired devices are actually available for connection right now.
-            available_busids = await self._get_remote_busids(server_name, local_port)
+            if available_busids is None:
+                available_busids = await self._get_remote_busids(server_name, local_port)
             if available_busids is None:
                 logging.warning(f"[{server_name}] Could not get available device list. Will retry attach on next sync.")
-                return
+                available_busids = set()
             
             # Attach devices that are both desired and available.
             to_attach = to_attach_candidates.intersection(available_busids)
             if to_attach:
                 logging.info(f"[{server_name}] Attaching newly configured devices: {to_attach}")
-                for busid in to_attach:
-                    if await self._attach_busid(local_port, busid):
-                        self.attached_devices_by_server.setdefault(server_name, set()).add(busid)
+                ready = {busid for busid in to_attach if not self.attach_scheduler.is_backing_off(server_name, busid)}
+                device_ports = await self._open_device_channels(server_name, ready)
+                attached = await self.attach_scheduler.attach_all(server_name, local_port, to_attach, device_ports)
+                if attached:
+                    self.attached_devices_by_server.setdefault(server_name, set()).update(attached)
+                    self._record_recoveries(server_name, attached)
+
+        reconnected_at = self._reconnected_at.get(server_name)
+        if reconnected_at is not None and not self.has_pending_attaches(server_name):
+            del self._reconnected_at[server_name]
+            count = len(self.attached_devices_by_server.get(server_name, set()))
+            logging.info(
+                f"[{server_name}] All {count} device(s) attached "
+                f"{time.monotonic() - reconnected_at:.2f}s after the tunnel came up."
+            )
 
     async def detach_all_for_server(self, server_name: str):
         """Forcefully detaches all known devices for a given server."""
+        self.remote_devices_by_server.pop(server_name, None)
+        self.desired_devices_by_server.pop(server_name, None)
+        self._desired_versions.pop(server_name, None)
+        self._sync_versions.pop(server_name, None)
+        self.available_devices_by_server.pop(server_name, None)
+        self._reconnected_at.pop(server_name, None)
+        self.device_priorities_by_server.pop(server_name, None)
+        for key in [key for key in self._failed_at if key[0] == server_name]:
+            del self._failed_at[key]
         busids = self.attached_devices_by_server.get(server_name, set())
         if not busids:
+            await self._close_device_channels(server_name, set(self.device_ports_by_server.get(server_name, {})))
             return
         logging.info(f"[{server_name}] Detaching all known devices for server: {busids}")
-        await self._detach_busids(busids)
+        await self._detach_busids(server_name, busids)
+        await self._close_device_channels(server_name, set(self.device_ports_by_server.get(server_name, {})))
         if server_name in self.attached_devices_by_server:
-            del self.attached_devices_by_server[server_name] 
\ No newline at end of file
+            del self.attached_devices_by_server[server_name]
+        local_port = self.local_ports_by_server.pop(server_name, None)
+        self._servers_by_local_port.pop(local_port, None) 
\ No newline at end of file
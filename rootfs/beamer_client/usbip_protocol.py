@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import socket
+import struct
+from dataclasses import dataclass, field
+
+# Protocol constants (see Documentation/usb/usbip_protocol.rst in the kernel tree).
+USBIP_VERSION = 0x0111
+OP_REQ_DEVLIST = 0x8005
+OP_REP_DEVLIST = 0x0005
+ST_OK = 0x00000000
+
+# Wire layouts, all fields are big-endian (network byte order).
+OP_HEADER = struct.Struct("!HHI")            # version, code, status
+DEVLIST_COUNT = struct.Struct("!I")          # number of exported devices
+USB_DEVICE = struct.Struct("!256s32sIIIHHHBBBBBB")
+USB_INTERFACE = struct.Struct("!BBBx")       # class, subclass, protocol, padding
+
+# Mirrors 'enum usb_device_speed' from the kernel.
+USB_SPEEDS = {
+    0: "unknown",
+    1: "low",
+    2: "full",
+    3: "high",
+    4: "wireless",
+    5: "super",
+    6: "super_plus",
+}
+
+DEFAULT_TIMEOUT = 5.0
+
+
+class USBIPProtocolError(Exception):
+    """Raised when a USB/IP peer sends a malformed or unexpected reply."""
+
+
+@dataclass
+class USBInterface:
+    """A single interface descriptor as reported in an OP_REP_DEVLIST reply."""
+    interface_class: int
+    interface_subclass: int
+    interface_protocol: int
+
+
+@dataclass
+class USBDevice:
+    """A device exported by a remote usbipd, as reported in an OP_REP_DEVLIST reply."""
+    path: str
+    busid: str
+    busnum: int
+    devnum: int
+    speed: str
+    vendor_id: int
+    product_id: int
+    bcd_device: int
+    device_class: int
+    device_subclass: int
+    device_protocol: int
+    configuration_value: int
+    num_configurations: int
+    interfaces: list[USBInterface] = field(default_factory=list)
+
+    @property
+    def usb_id(self) -> str:
+        """Returns the 'vvvv:pppp' identifier used by lsusb and usbip."""
+        return f"{self.vendor_id:04x}:{self.product_id:04x}"
+
+
+def _decode_cstring(raw: bytes) -> str:
+    return raw.split(b"\0", 1)[0].decode(errors="replace")
+
+
+def _parse_device(raw: bytes) -> tuple[USBDevice, int]:
+    """Decodes a usbip_usb_device record and returns it with its interface count."""
+    (path, busid, busnum, devnum, speed, vendor_id, product_id, bcd_device,
+     device_class, device_subclass, device_protocol, configuration_value,
+     num_configurations, num_interfaces) = USB_DEVICE.unpack(raw)
+    device = USBDevice(
+        path=_decode_cstring(path),
+        busid=_decode_cstring(busid),
+        busnum=busnum,
+        devnum=devnum,
+        speed=USB_SPEEDS.get(speed, "unknown"),
+        vendor_id=vendor_id,
+        product_id=product_id,
+        bcd_device=bcd_device,
+        device_class=device_class,
+        device_subclass=device_subclass,
+        device_protocol=device_protocol,
+        configuration_value=configuration_value,
+        num_configurations=num_configurations,
+    )
+    return device, num_interfaces
+
+
+async def _read_devlist(reader: asyncio.StreamReader) -> list[USBDevice]:
+    """Reads and decodes an OP_REP_DEVLIST reply from the stream."""
+    version, code, status = OP_HEADER.unpack(await reader.readexactly(OP_HEADER.size))
+    if code != OP_REP_DEVLIST:
+        raise USBIPProtocolError(f"Unexpected reply code 0x{code:04x} (version 0x{version:04x}).")
+    if status != ST_OK:
+        raise USBIPProtocolError(f"Server rejected device list request with status {status}.")
+
+    (count,) = DEVLIST_COUNT.unpack(await reader.readexactly(DEVLIST_COUNT.size))
+    devices = []
+    for _ in range(count):
+        device, num_interfaces = _parse_device(await reader.readexactly(USB_DEVICE.size))
+        for _ in range(num_interfaces):
+            device.interfaces.append(
+                USBInterface(*USB_INTERFACE.unpack(await reader.readexactly(USB_INTERFACE.size)))
+            )
+        devices.append(device)
+    return devices
+
+
+async def list_remote_devices(host: str, port: int, timeout: float = DEFAULT_TIMEOUT) -> list[USBDevice]:
+    """Performs an OP_REQ_DEVLIST exchange with a usbipd and returns the exported devices.
+
+    This is the in-process equivalent of 'usbip list --remote=HOST --tcp-port=PORT'.
+    Raises OSError, asyncio.TimeoutError or USBIPProtocolError on failure.
+    """
+    async def exchange() -> list[USBDevice]:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            sock = writer.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REQ_DEVLIST, ST_OK))
+            await writer.drain()
+            try:
+                return await _read_devlist(reader)
+            except asyncio.IncompleteReadError as e:
+                raise USBIPProtocolError(
+                    f"Connection closed mid-reply after {len(e.partial)} bytes."
+                ) from e
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception as e:
+                logging.debug(f"Error while closing USB/IP connection to {host}:{port}: {e}")
+
+    return await asyncio.wait_for(exchange(), timeout=timeout)
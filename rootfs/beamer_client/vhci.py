@@ -0,0 +1,140 @@
+import asyncio
+import glob
+import logging
+import os
+from dataclasses import dataclass
+
+VHCI_SYSFS_ROOT = "/sys/devices/platform"
+VHCI_STATE_DIR = "/var/run/vhci_hcd"  # Where 'usbip attach' records the remote end of each port.
+
+# Mirrors 'enum usbip_device_status' from the kernel (drivers/usb/usbip/usbip_common.h).
+VDEV_ST_NULL = 4
+VDEV_ST_NOTASSIGNED = 5
+VDEV_ST_USED = 6
+VDEV_ST_ERROR = 7
+
+
+@dataclass
+class VHCIPort:
+    """State of a single vhci_hcd port, joined with the usbip attach record if one exists."""
+    port: int
+    hub: str
+    status: int
+    speed: int
+    devid: int
+    sockfd: int
+    local_busid: str
+    remote_host: str | None = None
+    remote_port: int | None = None
+    remote_busid: str | None = None
+
+    @property
+    def in_use(self) -> bool:
+        return self.status in (VDEV_ST_USED, VDEV_ST_ERROR)
+
+    @property
+    def is_error(self) -> bool:
+        return self.status == VDEV_ST_ERROR
+
+
+def _parse_status_line(line: str) -> VHCIPort | None:
+    """Parses a 'hub port sta spd dev sockfd local_busid' line from a vhci status file."""
+    fields = line.split()
+    if len(fields) != 7 or fields[0] not in ("hs", "ss"):
+        return None
+    try:
+        return VHCIPort(
+            port=int(fields[1]),
+            hub=fields[0],
+            status=int(fields[2]),
+            speed=int(fields[3]),
+            devid=int(fields[4], 16),
+            sockfd=int(fields[5]),
+            local_busid=fields[6],
+        )
+    except ValueError:
+        return None
+
+
+class VHCI:
+    """Reads and controls vhci_hcd port state directly through sysfs, without the usbip CLI."""
+
+    def __init__(self, sysfs_root: str = VHCI_SYSFS_ROOT, state_dir: str = VHCI_STATE_DIR):
+        # Both paths can be pointed at a fake tree to exercise this without the kernel module.
+        self.sysfs_root = sysfs_root
+        self.state_dir = state_dir
+
+    def _controller_dirs(self) -> list[str]:
+        return sorted(glob.glob(os.path.join(self.sysfs_root, "vhci_hcd.*")))
+
+    def _read_record(self, port: VHCIPort):
+        """Fills in the remote end of a port from the record written by 'usbip attach'."""
+        try:
+            with open(os.path.join(self.state_dir, f"port{port.port}")) as f:
+                host, service, busid = f.read().split()
+            port.remote_host = host
+            port.remote_port = int(service)
+            port.remote_busid = busid
+        except (OSError, ValueError):
+            pass
+
+    def read_ports(self) -> list[VHCIPort]:
+        """Returns the state of every vhci port. Blocking; use get_ports() from the event loop."""
+        ports = []
+        for controller in self._controller_dirs():
+            # vhci_hcd.0 exposes 'status' plus 'status.N' for each additional controller.
+            for status_path in sorted(glob.glob(os.path.join(controller, "status*"))):
+                try:
+                    with open(status_path) as f:
+                        lines = f.read().splitlines()
+                except OSError as e:
+                    logging.debug(f"Could not read {status_path}: {e}")
+                    continue
+                for line in lines[1:]:
+                    port = _parse_status_line(line)
+                    if port is None:
+                        continue
+                    if port.in_use:
+                        self._read_record(port)
+                    ports.append(port)
+        return ports
+
+    async def get_ports(self) -> list[VHCIPort]:
+        """Returns the state of every vhci port without blocking the event loop."""
+        return await asyncio.to_thread(self.read_ports)
+
+    def _detach_path(self) -> str | None:
+        for controller in self._controller_dirs():
+            path = os.path.join(controller, "detach")
+            if os.path.exists(path):
+                return path
+        return None
+
+    def detach_ports_sync(self, port_numbers) -> set:
+        """Detaches the given vhci ports and returns the ones that succeeded. Blocking."""
+        detach_path = self._detach_path()
+        if detach_path is None:
+            logging.error("No vhci_hcd detach attribute found. Is the vhci-hcd module loaded?")
+            return set()
+
+        detached = set()
+        for port_number in sorted(port_numbers):
+            try:
+                with open(detach_path, "w") as f:
+                    f.write(str(port_number))
+                detached.add(port_number)
+            except OSError as e:
+                logging.error(f"Failed to detach vhci port {port_number}: {e}")
+                continue
+            # Same cleanup 'usbip detach' does, so 'usbip port' stays consistent.
+            try:
+                os.remove(os.path.join(self.state_dir, f"port{port_number}"))
+            except OSError:
+                pass
+        return detached
+
+    async def detach_ports(self, port_numbers) -> set:
+        """Detaches the given vhci ports without blocking the event loop."""
+        if not port_numbers:
+            return set()
+        return await asyncio.to_thread(self.detach_ports_sync, set(port_numbers))
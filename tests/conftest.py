@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "rootfs", "beamer_client"))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from fake_vhci import FakeVHCI, create_fake_sysfs  # noqa: E402
+
+FAKE_VHCI_PORTS = 8
+
+
+@pytest.fixture
+def fake_vhci(tmp_path):
+    """A VHCI pointed at a fresh fake sysfs tree with FAKE_VHCI_PORTS free ports."""
+    sysfs_root, state_dir = str(tmp_path / "sys"), str(tmp_path / "run")
+    create_fake_sysfs(sysfs_root, state_dir, FAKE_VHCI_PORTS)
+    return FakeVHCI(sysfs_root, state_dir)
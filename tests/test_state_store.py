@@ -0,0 +1,27 @@
+import asyncio
+import json
+
+import state_store
+from state_store import StateStore
+
+
+def test_scheduled_save_is_written_and_flush_waits_for_it(tmp_path, monkeypatch):
+    monkeypatch.setattr(state_store, "SAVE_DELAY", 0)
+    path = tmp_path / "state.json"
+    store = StateStore(str(path))
+
+    async def run():
+        store.set_ports("beamer-server", 13240, 14240)
+        while store._flush_task is None:  # The delayed save starts its flush task.
+            await asyncio.sleep(0)
+        scheduled = store._flush_task
+        store.set_ports("other-server", 13241, 14241)
+        await store.flush()
+        assert scheduled.done()
+        assert store._flush_task is None
+
+    asyncio.run(run())
+    assert json.loads(path.read_text())["servers"] == {
+        "beamer-server": {"local_port": 13240, "local_http_port": 14240},
+        "other-server": {"local_port": 13241, "local_http_port": 14241},
+    }
@@ -0,0 +1,111 @@
+import asyncio
+
+from aiohttp import web
+
+from usb_manager import USBManager
+
+SERVER = "beamer-server"
+
+
+def _run(replies: list) -> tuple[list, list, USBManager]:
+    """Serves the given replies to successive sync-state requests.
+
+    Returns the result of each _get_sync_state() call, the 'since' parameter each
+    request carried, and the manager.
+    """
+    results, sinces = [], []
+    manager = USBManager()
+    pending = list(replies)
+
+    async def handle(request):
+        sinces.append(request.query.get("since"))
+        return pending.pop(0)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/api/sync-state", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            for _ in replies:
+                results.append(await manager._get_sync_state(SERVER, port))
+                # What _sync_devices does with a reply, which later diffs are based on.
+                if results[-1] is not None:
+                    manager.desired_devices_by_server[SERVER] = results[-1][0]
+        finally:
+            # Not manager.close(), which also forgets the per-server state checked below.
+            for session in manager._http_sessions.values():
+                await session.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+    return results, sinces, manager
+
+
+def test_full_state_then_diff_then_unchanged():
+    results, sinces, manager = _run([
+        web.json_response({
+            "version": 1,
+            "desired": ["1-1", {"busid": "1-2", "priority": "realtime"}],
+            "available": ["1-1", "1-2"],
+        }),
+        web.json_response({
+            "version": 2,
+            "desired_added": ["1-3"],
+            "desired_removed": ["1-1"],
+            "available_added": ["1-3"],
+            "available_removed": [],
+        }),
+        web.json_response({"version": 2, "unchanged": True}),
+    ])
+    assert sinces == [None, "1", "2"]
+    assert results[0] == ({"1-1", "1-2"}, {"1-1", "1-2"}, True)
+    assert results[1] == ({"1-2", "1-3"}, {"1-1", "1-2", "1-3"}, True)
+    assert results[2] == ({"1-2", "1-3"}, {"1-1", "1-2", "1-3"}, False)
+    assert manager.device_priorities_by_server[SERVER] == {"1-2": "realtime", "1-3": "normal"}
+    assert manager._combined_sync[SERVER] is True
+
+
+def test_full_state_is_sent_again_when_the_server_cannot_diff():
+    results, sinces, _ = _run([
+        web.json_response({"version": 1, "desired": ["1-1"], "available": ["1-1"]}),
+        web.json_response({"version": 7, "desired": ["1-2"], "available": ["1-2"]}),
+    ])
+    assert sinces == [None, "1"]
+    assert results[1] == ({"1-2"}, {"1-2"}, True)
+
+
+def test_json_without_sync_state_means_no_endpoint():
+    # A catch-all route must not be taken for "desire nothing", which would detach everything.
+    for reply in (web.json_response({"status": "ok"}), web.json_response([1, 2]), web.Response(text="<html>")):
+        results, _, manager = _run([reply])
+        assert results == [None]
+        assert manager._combined_sync[SERVER] is False
+        assert SERVER not in manager.device_priorities_by_server
+
+
+def test_diff_keys_are_ignored_without_a_base():
+    results, _, manager = _run([web.json_response({"version": 3, "unchanged": True})])
+    assert results == [None]
+    assert manager._combined_sync[SERVER] is False
+
+
+def test_invalid_state_is_skipped_and_full_state_requested_next():
+    results, sinces, manager = _run([
+        web.json_response({"version": 1, "desired": ["1-1"], "available": ["1-1"]}),
+        web.json_response({"version": 2, "desired": None}),
+        web.json_response({"version": 2, "desired": ["1-1"], "available": ["1-1"]}),
+    ])
+    assert results[1] is None
+    assert sinces == [None, "1", None]
+    assert results[2] == ({"1-1"}, {"1-1"}, True)
+    assert manager._combined_sync[SERVER] is True
+
+
+def test_endpoint_missing_falls_back():
+    results, _, manager = _run([web.Response(status=404)])
+    assert results == [None]
+    assert manager._combined_sync[SERVER] is False
@@ -0,0 +1,40 @@
+import asyncio
+import sys
+
+import transport
+from transport import OpenSSHTransport
+
+
+def _openssh_transport(command: list) -> OpenSSHTransport:
+    """Returns an OpenSSH transport whose 'ssh' process is the given command."""
+    ssh = OpenSSHTransport("beamer-server", "127.0.0.1", 22, "root", "/dev/null", [(13240, 3240)])
+    ssh._build_command = lambda: command
+    return ssh
+
+
+def test_aclose_returns_once_ssh_has_exited():
+    ssh = _openssh_transport(["sleep", "30"])
+
+    async def run():
+        ssh.process = await asyncio.create_subprocess_exec(*ssh._build_command())
+        await ssh.aclose()
+
+    asyncio.run(run())
+    assert ssh.process.returncode is not None
+    assert not ssh.is_open
+
+
+def test_aclose_kills_ssh_that_ignores_sigterm(monkeypatch):
+    monkeypatch.setattr(transport, "CLOSE_TIMEOUT", 0.2)
+    ignore_sigterm = "import signal, sys, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); print(flush=True); time.sleep(30)"
+    ssh = _openssh_transport([sys.executable, "-c", ignore_sigterm])
+
+    async def run():
+        ssh.process = await asyncio.create_subprocess_exec(
+            *ssh._build_command(), stdout=asyncio.subprocess.PIPE
+        )
+        await ssh.process.stdout.readline()  # The handler is installed.
+        await ssh.aclose()
+
+    asyncio.run(run())
+    assert ssh.process.returncode is not None
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from fake_vhci import claim_port, fail_ports
+from usb_manager import USBManager
+
+SERVER = "beamer-server"
+LOCAL_PORT = 13240
+LOCAL_HTTP_PORT = 14240
+
+
+def _manager(vhci, attached: set) -> tuple[USBManager, list]:
+    """Returns a manager with the given devices attached through fake vhci ports, and its attach log."""
+    manager = USBManager(vhci=vhci)
+    manager.local_ports_by_server[SERVER] = LOCAL_PORT
+    manager.desired_devices_by_server[SERVER] = set(attached)
+    manager.attached_devices_by_server[SERVER] = set(attached)
+    for busid in sorted(attached):
+        claim_port(vhci.sysfs_root, vhci.state_dir, "127.0.0.1", LOCAL_PORT, busid)
+    attaches = []
+
+    async def attach(local_port, busid):
+        attaches.append(busid)
+        claim_port(vhci.sysfs_root, vhci.state_dir, "127.0.0.1", local_port, busid)
+        return True
+
+    manager.attach_scheduler._attach_func = attach
+    return manager, attaches
+
+
+def test_watchdog_repair_is_not_imported_again_by_a_concurrent_sync(fake_vhci):
+    manager, attaches = _manager(fake_vhci, {"1-1", "1-2"})
+    fail_ports(fake_vhci.sysfs_root, [0])
+    detaching = asyncio.Event()
+    detach_ports = fake_vhci.detach_ports
+
+    async def slow_detach(port_numbers):
+        detaching.set()
+        await asyncio.sleep(0.05)  # Leaves room for the sync to run mid-repair.
+        return await detach_ports(port_numbers)
+
+    async def sync_state(server_name, local_http_port):
+        await detaching.wait()
+        return {"1-1", "1-2"}, {"1-1", "1-2"}, True
+
+    fake_vhci.detach_ports = slow_detach
+    manager._get_sync_state = sync_state
+
+    async def run():
+        await asyncio.gather(
+            manager.check_attached_devices(SERVER, LOCAL_PORT),
+            manager.scan_and_sync_devices(SERVER, LOCAL_PORT, LOCAL_HTTP_PORT),
+        )
+
+    asyncio.run(run())
+    assert attaches == ["1-1"]
+    assert manager.attached_devices_by_server[SERVER] == {"1-1", "1-2"}
+    assert not manager._repairing[SERVER]
+
+
+def test_watchdog_leaves_healthy_devices_alone(fake_vhci):
+    manager, attaches = _manager(fake_vhci, {"1-1", "1-2"})
+    asyncio.run(manager.check_attached_devices(SERVER, LOCAL_PORT))
+    assert attaches == []
+    assert manager.attached_devices_by_server[SERVER] == {"1-1", "1-2"}
+
+
+def test_only_available_devices_that_are_not_backing_off_are_pending(fake_vhci):
+    manager, _ = _manager(fake_vhci, {"1-1"})
+    manager.desired_devices_by_server[SERVER] = {"1-1", "1-2", "1-3"}
+    manager.available_devices_by_server[SERVER] = {"1-1", "1-3"}
+    manager.attach_scheduler._retry_at[(SERVER, "1-3")] = time.monotonic() + 60
+    # 1-2 is unplugged and 1-3 waits for its retry, so neither keeps the server polling.
+    assert not manager.has_pending_attaches(SERVER)
+
+    manager.attach_scheduler._retry_at.clear()
+    assert manager.has_pending_attaches(SERVER)
+
+
+def test_unchanged_configuration_with_an_unplugged_device_skips_the_attach_pipeline(fake_vhci):
+    manager, attaches = _manager(fake_vhci, {"1-1"})
+    manager.desired_devices_by_server[SERVER] = {"1-1", "1-2"}
+    listed = []
+
+    async def desired_busids(server_name, local_http_port):
+        return {"1-1", "1-2"}, False
+
+    async def remote_busids(server_name, local_port):
+        listed.append(server_name)
+        manager.remote_devices_by_server[server_name] = {"1-1": None}
+        return {"1-1"}
+
+    manager._combined_sync[SERVER] = False
+    manager._get_desired_busids = desired_busids
+    manager._get_remote_busids = remote_busids
+    asyncio.run(manager.scan_and_sync_devices(SERVER, LOCAL_PORT, LOCAL_HTTP_PORT))
+    # The device list is read again to notice 1-2 coming back, but nothing is attached.
+    assert listed == [SERVER]
+    assert attaches == []
+    assert not manager.has_pending_attaches(SERVER)
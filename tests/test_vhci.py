@@ -0,0 +1,47 @@
+import os
+
+from conftest import FAKE_VHCI_PORTS
+from fake_vhci import claim_port, fail_ports
+from vhci import VDEV_ST_NULL, VDEV_ST_USED, VHCI
+
+
+def test_read_ports_lists_free_ports(fake_vhci):
+    ports = fake_vhci.read_ports()
+    assert [port.port for port in ports] == list(range(FAKE_VHCI_PORTS))
+    assert all(port.status == VDEV_ST_NULL and not port.in_use for port in ports)
+    assert all(port.remote_busid is None for port in ports)
+
+
+def test_read_ports_joins_attach_records(fake_vhci):
+    first = claim_port(fake_vhci.sysfs_root, fake_vhci.state_dir, "127.0.0.1", 13240, "1-1")
+    second = claim_port(fake_vhci.sysfs_root, fake_vhci.state_dir, "127.0.0.1", 13241, "1-2")
+    fail_ports(fake_vhci.sysfs_root, [second])
+
+    ports = {port.port: port for port in fake_vhci.read_ports()}
+    assert ports[first].status == VDEV_ST_USED and not ports[first].is_error
+    assert (ports[first].remote_host, ports[first].remote_port, ports[first].remote_busid) == ("127.0.0.1", 13240, "1-1")
+    assert ports[second].in_use and ports[second].is_error
+    assert ports[second].remote_busid == "1-2"
+    assert ports[first].devid != 0 and ports[first].local_busid != "0-0"
+
+
+def test_detach_ports_sync_writes_detach_and_removes_record(fake_vhci):
+    port = claim_port(fake_vhci.sysfs_root, fake_vhci.state_dir, "127.0.0.1", 13240, "1-1")
+
+    # The plain VHCI only talks to sysfs; the fake kernel side is not involved.
+    assert VHCI.detach_ports_sync(fake_vhci, [port]) == {port}
+    with open(os.path.join(fake_vhci.sysfs_root, "vhci_hcd.0", "detach")) as f:
+        assert f.read() == str(port)
+    assert not os.path.exists(os.path.join(fake_vhci.state_dir, f"port{port}"))
+
+
+def test_detach_frees_fake_port(fake_vhci):
+    port = claim_port(fake_vhci.sysfs_root, fake_vhci.state_dir, "127.0.0.1", 13240, "1-1")
+    fake_vhci.detach_ports_sync([port])
+    assert not any(p.in_use for p in fake_vhci.read_ports())
+
+
+def test_detach_without_vhci_module(tmp_path):
+    vhci = VHCI(str(tmp_path / "missing"), str(tmp_path / "run"))
+    assert vhci.read_ports() == []
+    assert vhci.detach_ports_sync([0]) == set()
@@ -0,0 +1,127 @@
+"""Fake vhci-hcd sysfs tree for exercising the client's VHCI code without the kernel module.
+
+Lays out <sysfs_root>/vhci_hcd.0/{status,detach} and <state_dir>/portN the way
+vhci-hcd and the usbip CLI do, so VHCI can be pointed at it unchanged. Used by the
+simulation harness and the tests. Example:
+
+    create_fake_sysfs(sysfs_root, state_dir, num_ports=8)
+    port = claim_port(sysfs_root, state_dir, "127.0.0.1", 13240, "1-1")
+    vhci = FakeVHCI(sysfs_root, state_dir)
+    vhci.detach_ports_sync([port])
+"""
+import fcntl
+import os
+import sys
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rootfs", "beamer_client")
+if os.path.abspath(CLIENT_DIR) not in sys.path:
+    sys.path.insert(0, os.path.abspath(CLIENT_DIR))
+
+from vhci import VDEV_ST_ERROR, VDEV_ST_NULL, VDEV_ST_USED, VHCI  # noqa: E402
+
+STATUS_HEADER = "hub port sta spd dev      sockfd local_busid"
+
+
+def _status_path(sysfs_root: str) -> str:
+    return os.path.join(sysfs_root, "vhci_hcd.0", "status")
+
+
+def _free_port_line(port: int) -> str:
+    return f"hs  {port:04d} {VDEV_ST_NULL:03d} 000 00000000 000000 0-0"
+
+
+def _used_port_line(port: int) -> str:
+    return f"hs  {port:04d} {VDEV_ST_USED:03d} 002 {port + 1:08x} {port + 3:06d} 9-{port + 1}"
+
+
+def create_fake_sysfs(sysfs_root: str, state_dir: str, num_ports: int):
+    """Creates a vhci_hcd.0 directory with a status file listing num_ports free ports."""
+    os.makedirs(os.path.join(sysfs_root, "vhci_hcd.0"), exist_ok=True)
+    os.makedirs(state_dir, exist_ok=True)
+    lines = [STATUS_HEADER] + [_free_port_line(port) for port in range(num_ports)]
+    with open(_status_path(sysfs_root), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    open(os.path.join(sysfs_root, "vhci_hcd.0", "detach"), "w").close()
+
+
+def update_status(sysfs_root: str, update):
+    """Applies update(lines) -> result to the fake status file under an exclusive lock.
+
+    The new contents are swapped in with a rename, so readers, which do not take the
+    lock, always see a whole file as they would from sysfs. The lock and temporary
+    files live outside vhci_hcd.0, where VHCI would take them for status files.
+    """
+    with open(os.path.join(sysfs_root, ".status.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(_status_path(sysfs_root)) as f:
+            lines = f.read().splitlines()
+        result = update(lines)
+        tmp_path = os.path.join(sysfs_root, ".status.tmp")
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, _status_path(sysfs_root))
+        return result
+
+
+def claim_port(sysfs_root: str, state_dir: str, host: str, remote_port: int, busid: str) -> int | None:
+    """Marks the lowest free port as in use and records its import, as 'usbip attach' does.
+
+    Returns the vhci port number, or None if every port is taken.
+    """
+
+    def claim(lines):
+        for index, line in enumerate(lines[1:]):
+            if line.split()[2] == f"{VDEV_ST_NULL:03d}":
+                lines[index + 1] = _used_port_line(index)
+                # Written under the lock, so the port is never seen in use without its record.
+                with open(os.path.join(state_dir, f"port{index}"), "w") as f:
+                    f.write(f"{host} {remote_port} {busid}\n")
+                return index
+        return None
+
+    return update_status(sysfs_root, claim)
+
+
+def free_ports(sysfs_root: str, state_dir: str, port_numbers):
+    """Returns ports to the free state and removes their records, as the kernel does when an import ends."""
+
+    def free(lines):
+        for port in port_numbers:
+            lines[port + 1] = _free_port_line(port)
+            try:
+                os.remove(os.path.join(state_dir, f"port{port}"))
+            except OSError:
+                pass
+
+    update_status(sysfs_root, free)
+
+
+class FakeVHCI(VHCI):
+    """VHCI whose detach also frees the port in the fake status file, like the kernel would.
+
+    on_detach, if given, is called with the detached ports before they are freed, so
+    whatever stands in for the kernel can drop the connections behind them.
+    """
+
+    def __init__(self, *args, on_detach=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_detach = on_detach
+
+    def detach_ports_sync(self, port_numbers) -> set:
+        detached = super().detach_ports_sync(port_numbers)
+        if self.on_detach is not None:
+            self.on_detach(detached)
+        free_ports(self.sysfs_root, self.state_dir, detached)
+        return detached
+
+
+def fail_ports(sysfs_root: str, port_numbers):
+    """Puts the given fake vhci ports into the error state, as a broken USB/IP connection does."""
+
+    def fail(lines):
+        for port in port_numbers:
+            fields = lines[port + 1].split()
+            fields[2] = f"{VDEV_ST_ERROR:03d}"
+            lines[port + 1] = " ".join(fields)
+
+    update_status(sysfs_root, fail)
@@ -0,0 +1,719 @@
+#!/usr/bin/env python3
+"""Local simulation and benchmark harness for the USB Beamer client.
+
+Runs N fake USB Beamer servers on a separate thread and drives the real SSHManager
+and USBManager against them, without hardware, SSH, mDNS or the vhci-hcd module:
+
+- each fake server runs a stand-in usbipd (OP_REQ_DEVLIST / OP_REQ_IMPORT) and a
+  stand-in /api/exported-devices HTTP API with ETag and change push support;
+- servers are announced by injecting Zeroconf Added/Updated/Removed events into
+  DiscoveryManager;
+- SSH tunnels are replaced by in-process TCP relays;
+- the 'usbip' CLI is replaced by a shell stub on PATH that hands the import to a
+  fake vhci-hcd driver, which holds the connection and records the device in a
+  fake vhci sysfs tree for as long as the connection lives.
+
+Reports discovery-to-attach latency, reconnect recovery time, CPU time per server
+and peak memory. Example:
+
+    python3 tools/simulate.py --servers 100 --devices 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rootfs", "beamer_client")
+sys.path.insert(0, os.path.abspath(CLIENT_DIR))
+
+from fake_vhci import FakeVHCI, claim_port, create_fake_sysfs, fail_ports, free_ports  # noqa: E402
+from usbip_protocol import (  # noqa: E402
+    DEVLIST_COUNT, OP_HEADER, OP_REP_DEVLIST, OP_REQ_DEVLIST, ST_OK, USB_DEVICE, USB_INTERFACE, USBIP_VERSION,
+)
+
+OP_REQ_IMPORT = 0x8003
+OP_REP_IMPORT = 0x0003
+ST_NA = 0x00000001
+IMPORT_BUSID = struct.Struct("!32s")
+
+ENV_DRIVER_PORT = "BEAMER_SIM_VHCI_DRIVER_PORT"
+
+POLL_INTERVAL = 0.02
+
+
+# ---------------------------------------------------------------------------
+# Fake 'usbip' CLI and vhci-hcd driver.
+# ---------------------------------------------------------------------------
+
+# A shell script rather than Python, so a spawn costs milliseconds, not an interpreter start.
+USBIP_STUB = """#!/usr/bin/env bash
+# Fake 'usbip --tcp-port=N attach --remote=H --busid=B': hands the import to the harness.
+for arg in "$@"; do
+    case $arg in
+        --tcp-port=*) port=${arg#*=} ;;
+        --remote=*) host=${arg#*=} ;;
+        --busid=*) busid=${arg#*=} ;;
+    esac
+done
+if [[ " $* " != *" attach "* ]]; then
+    echo "usbip stub: unsupported command $*" >&2
+    exit 1
+fi
+exec 3<>/dev/tcp/127.0.0.1/$%s || exit 1
+echo "$host $port $busid" >&3
+read -r status message <&3
+if [[ $status != ok ]]; then
+    echo "usbip: error: $message" >&2
+    exit 1
+fi
+""" % ENV_DRIVER_PORT
+
+
+def install_usbip_stub(bin_dir: str):
+    """Writes an executable 'usbip' stub into bin_dir and puts it first on PATH."""
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "usbip")
+    with open(path, "w") as f:
+        f.write(USBIP_STUB)
+    os.chmod(path, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+
+class FakeVHCIDriver:
+    """Plays the vhci-hcd side of 'usbip attach': imports the device and holds its connection.
+
+    As with the real driver, an import lives exactly as long as its connection: when the
+    tunnel it runs through goes down, the port is freed, even if the 'usbip' process that
+    asked for it finished after the client had given up on it. Detaching a port closes
+    the connection behind it.
+    """
+
+    def __init__(self, sysfs_root: str, state_dir: str):
+        self.sysfs_root = sysfs_root
+        self.state_dir = state_dir
+        self.port = None
+        self._loop = None
+        self._server = None
+        # Maps a vhci port to the writer of the connection holding it. Shared with detaches
+        # from the client's threads, hence the lock.
+        self._imports = {}
+        self._lock = threading.Lock()
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle_attach, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _import(self, host: str, port: int, busid: str):
+        """Sends OP_REQ_IMPORT through the tunnel and returns the open connection on success."""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=5)
+        try:
+            writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REQ_IMPORT, ST_OK) + IMPORT_BUSID.pack(busid.encode()))
+            await writer.drain()
+            _, _, status = OP_HEADER.unpack(await asyncio.wait_for(reader.readexactly(OP_HEADER.size), timeout=5))
+            if status != ST_OK:
+                raise ConnectionError(f"import device {busid} failed")
+            await reader.readexactly(USB_DEVICE.size)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _handle_attach(self, control_reader, control_writer):
+        try:
+            host, port, busid = (await control_reader.readline()).decode().split()
+            try:
+                reader, writer = await self._import(host, int(port), busid)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                control_writer.write(f"error {str(e) or repr(e)}\n".encode())
+                return
+            with self._lock:
+                vhci_port = claim_port(self.sysfs_root, self.state_dir, host, int(port), busid)
+                if vhci_port is not None:
+                    self._imports[vhci_port] = writer
+            if vhci_port is None:
+                writer.close()
+                control_writer.write(b"error no free port\n")
+                return
+            control_writer.write(f"ok {vhci_port}\n".encode())
+            asyncio.create_task(self._hold(vhci_port, reader, writer))
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            control_writer.close()
+
+    async def _hold(self, vhci_port: int, reader, writer):
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+        with self._lock:
+            if self._imports.get(vhci_port) is not writer:
+                return  # Detached already, and the port may belong to a newer import by now.
+            del self._imports[vhci_port]
+            free_ports(self.sysfs_root, self.state_dir, [vhci_port])
+        writer.close()
+
+    def release(self, vhci_ports):
+        """Drops the connections behind detached ports. Safe to call from any thread."""
+        with self._lock:
+            writers = [self._imports.pop(port) for port in vhci_ports if port in self._imports]
+        for writer in writers:
+            self._loop.call_soon_threadsafe(writer.close)
+
+    def close(self):
+        self.release(list(self._imports))
+        if self._server:
+            self._server.close()
+
+
+# ---------------------------------------------------------------------------
+# Fake servers.
+# ---------------------------------------------------------------------------
+
+class FakeServiceInfo:
+    """The subset of zeroconf's AsyncServiceInfo the client uses."""
+
+    def __init__(self, name: str, server: str, port: int, addresses=("127.0.0.1",)):
+        self.name = name
+        self.server = server
+        self.port = port
+        self.addresses = list(addresses)
+
+    def parsed_addresses(self):
+        return self.addresses
+
+
+class FakeUSBIPServer:
+    """A stand-in beamer server: usbipd plus the device configuration HTTP API."""
+
+    def __init__(self, index: int, num_devices: int, realtime_devices: int = 0, combined_api: bool = True):
+        self.name = f"sim-server-{index}._usbip._tcp.local."
+        self.busids = [f"1-{device + 1}" for device in range(num_devices)]
+        self.exported = set(self.busids)
+        # The first devices are marked latency sensitive in the device configuration.
+        self.priorities = {busid: "realtime" for busid in self.busids[:realtime_devices]}
+        self.combined_api = combined_api
+        # Maps a config version to the exported set it had, for diffs on the combined endpoint.
+        self.history = {1: frozenset(self.exported)}
+        # Requests served per kind, to count the round trips syncs cost.
+        self.requests = {"devlist": 0, "exported-devices": 0, "sync-state": 0}
+        self.version = 1
+        self.usbipd_port = None
+        self.http_port = None
+        self._servers = []
+        self._runner = None
+        self._subscribers = set()
+        self._imports = set()
+
+    def _device_record(self, busid: str) -> bytes:
+        busnum, devnum = 1, int(busid.split("-")[1])
+        return USB_DEVICE.pack(
+            f"/sys/devices/platform/sim/usb1/{busid}".encode(), busid.encode(),
+            busnum, devnum, 2, 0x10C4, 0xEA60, 0x0100, 0, 0, 0, 1, 1, 1,
+        )
+
+    async def _handle_usbip(self, reader, writer):
+        try:
+            version, code, status = OP_HEADER.unpack(await reader.readexactly(OP_HEADER.size))
+            if code == OP_REQ_DEVLIST:
+                self.requests["devlist"] += 1
+                reply = OP_HEADER.pack(USBIP_VERSION, OP_REP_DEVLIST, ST_OK) + DEVLIST_COUNT.pack(len(self.exported))
+                for busid in sorted(self.exported):
+                    reply += self._device_record(busid) + USB_INTERFACE.pack(0xFF, 0, 0)
+                writer.write(reply)
+            elif code == OP_REQ_IMPORT:
+                (raw_busid,) = IMPORT_BUSID.unpack(await reader.readexactly(IMPORT_BUSID.size))
+                busid = raw_busid.split(b"\0", 1)[0].decode()
+                if busid in self.exported:
+                    writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REP_IMPORT, ST_OK) + self._device_record(busid))
+                    await writer.drain()
+                    # Like usbipd, keep the connection for the device's traffic until the client drops it.
+                    self._imports.add(writer)
+                    while await reader.read(4096):
+                        pass
+                else:
+                    writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REP_IMPORT, ST_NA))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._imports.discard(writer)
+            writer.close()
+
+    async def _handle_devices(self, request):
+        from aiohttp import web
+
+        if request.headers.get("Accept") == "text/event-stream":
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            queue = asyncio.Queue()
+            self._subscribers.add(queue)
+            try:
+                # A None item means the config changed; False means the server is shutting down.
+                while await queue.get() is None:
+                    await response.write(b"event: changed\ndata: {}\n\n")
+            except ConnectionError:
+                pass
+            finally:
+                self._subscribers.discard(queue)
+            return response
+
+        self.requests["exported-devices"] += 1
+        etag = f'"{self.version}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.json_response(self._desired(self.exported), headers={"ETag": etag})
+
+    def _desired(self, busids) -> list:
+        return [
+            {"busid": busid, "priority": self.priorities[busid]} if busid in self.priorities else busid
+            for busid in sorted(busids)
+        ]
+
+    async def _handle_sync_state(self, request):
+        from aiohttp import web
+
+        self.requests["sync-state"] += 1
+        since = request.query.get("since")
+        base = self.history.get(int(since)) if since and since.isdigit() else None
+        if base is None:
+            # Desired and exportable are the same set here: the sim exports what it is configured to.
+            return web.json_response(
+                {"version": self.version, "desired": self._desired(self.exported), "available": sorted(self.exported)}
+            )
+        if int(since) == self.version:
+            return web.json_response({"version": self.version, "unchanged": True})
+        added, removed = sorted(self.exported - base), sorted(base - self.exported)
+        return web.json_response({
+            "version": self.version,
+            "desired_added": self._desired(added),
+            "desired_removed": removed,
+            "available_added": added,
+            "available_removed": removed,
+        })
+
+    def set_exported(self, busids):
+        """Changes the exported device set and pushes a change event to subscribers."""
+        self.exported = set(busids)
+        self.version += 1
+        self.history[self.version] = frozenset(self.exported)
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+
+    async def start(self):
+        from aiohttp import web
+
+        usbipd = await asyncio.start_server(self._handle_usbip, "127.0.0.1", 0)
+        self._servers.append(usbipd)
+        self.usbipd_port = usbipd.sockets[0].getsockname()[1]
+
+        app = web.Application()
+        app.router.add_get("/api/exported-devices", self._handle_devices)
+        if self.combined_api:
+            app.router.add_get("/api/sync-state", self._handle_sync_state)
+        self._runner = web.AppRunner(app, access_log=None, handle_signals=False)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.http_port = site._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+        for writer in list(self._imports):
+            writer.close()
+        for queue in self._subscribers:
+            queue.put_nowait(False)
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class FakeServerThread:
+    """Runs the fake servers on their own event loop, so they do not compete with the client's loop."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="fake-servers", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    async def run(self, coro):
+        """Runs a coroutine on the fake servers' loop and returns its result."""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def call(self, func, *args):
+        """Calls a plain function on the fake servers' loop and returns its result."""
+
+        async def invoke():
+            return func(*args)
+
+        return await self.run(invoke())
+
+    async def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        await asyncio.to_thread(self._thread.join)
+        self.loop.close()
+
+
+class FakeZeroconf:
+    """Replaces AsyncZeroconf so discovery events can be injected."""
+
+    def __init__(self):
+        self.services = {}
+
+    async def async_get_service_info(self, service_type, name):
+        return self.services.get(name)
+
+    async def async_close(self):
+        pass
+
+
+# ---------------------------------------------------------------------------
+# Tunnel stand-in.
+# ---------------------------------------------------------------------------
+
+def build_relay_transport_class():
+    from transport import DirectTransport
+
+    class RelayTransport(DirectTransport):
+        """Stands in for an SSH tunnel by relaying to a fake server on localhost."""
+
+        def __init__(self, *args, targets: dict, **kwargs):
+            super().__init__(*args, **kwargs)
+            # Maps remote port to the fake server's real listening port.
+            self.targets = targets
+
+        def _remote_endpoint(self, remote_port):
+            return "127.0.0.1", self.targets[remote_port]
+
+    return RelayTransport
+
+
+def build_sim_ssh_manager_class():
+    from ssh_manager import REMOTE_HTTP_PORT, USBIP_REMOTE_PORT, SSHManager
+
+    RelayTransport = build_relay_transport_class()
+
+    class SimSSHManager(SSHManager):
+        """SSHManager whose tunnels are local relays to fake servers."""
+
+        def __init__(self, *args, fake_servers: dict, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.fake_servers = fake_servers
+            self.sim_transports = {}
+
+        def _create_transport(self, name, info, forwards, priority="normal"):
+            fake = self.fake_servers[info.name]
+            transport = RelayTransport(
+                name, info.server, info.port, self.user, "", forwards,
+                priority=priority,
+                targets={USBIP_REMOTE_PORT: fake.usbipd_port, REMOTE_HTTP_PORT: fake.http_port},
+            )
+            self.sim_transports[name] = transport
+            return transport
+
+    return SimSSHManager
+
+
+# ---------------------------------------------------------------------------
+# Scenario.
+# ---------------------------------------------------------------------------
+
+def _summary(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "p50": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+def _cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+async def _wait_until(predicate, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(POLL_INTERVAL)
+    return predicate()
+
+
+async def run_simulation(args) -> dict:
+    from zeroconf import ServiceStateChange
+
+    from discovery_manager import SERVICE_TYPE
+    from metrics import DEVICE_RTT_SECONDS, TUNNEL_BYTES
+    import profiling
+    from usb_manager import USBManager
+
+    if args.trace:
+        await profiling.enable(args.trace)
+    work_dir = tempfile.mkdtemp(prefix="beamer-sim-")
+    sysfs_root = os.path.join(work_dir, "sys")
+    state_dir = os.path.join(work_dir, "vhci_hcd")
+    num_victims = max(1, int(args.servers * args.reconnect_fraction))
+    # Enough vhci ports for the busiest phase: every device attached, plus either the victims'
+    # old imports that are still being torn down after a reconnect, or one failed port per
+    # server waiting to be detached during the repair.
+    num_ports = args.servers * args.devices + max(num_victims * args.devices, args.servers)
+    create_fake_sysfs(sysfs_root, state_dir, num_ports)
+    install_usbip_stub(os.path.join(work_dir, "bin"))
+
+    server_thread = FakeServerThread()
+    server_thread.start()
+    driver = FakeVHCIDriver(sysfs_root, state_dir)
+    await server_thread.run(driver.start())
+    os.environ[ENV_DRIVER_PORT] = str(driver.port)
+    fake_servers = {}
+    for index in range(args.servers):
+        fake = FakeUSBIPServer(index, args.devices, args.realtime_devices, combined_api=not args.legacy_api)
+        await server_thread.run(fake.start())
+        fake_servers[fake.name] = fake
+
+    vhci = FakeVHCI(sysfs_root, state_dir, on_detach=driver.release)
+    usb_manager = USBManager(attach_concurrency=args.attach_concurrency, vhci=vhci)
+    ssh_manager = build_sim_ssh_manager_class()(
+        usb_manager, fake_servers=fake_servers, handshake_concurrency=args.handshake_concurrency
+    )
+    zeroconf = FakeZeroconf()
+    ssh_manager.discovery.aiozc = zeroconf
+
+    def live_imports() -> set:
+        """Returns (local port, busid) for every device the fake kernel currently holds."""
+        return {(port.remote_port, port.remote_busid) for port in usb_manager.vhci.read_ports() if port.in_use}
+
+    def fully_attached(name: str, live: set) -> bool:
+        """True when the client believes all exported devices are attached and the fake kernel agrees."""
+        if usb_manager.attached_devices_by_server.get(name, set()) != fake_servers[name].exported:
+            return False
+        return all((usb_manager._expected_port(name, busid), busid) in live for busid in fake_servers[name].exported)
+
+    cpu_started = _cpu_seconds()
+    results = {"servers": args.servers, "devices_per_server": args.devices}
+
+    # Discovery: announce every server at once, as after a client restart.
+    announced_at = {}
+    for name in fake_servers:
+        zeroconf.services[name] = FakeServiceInfo(name, "127.0.0.1", 22)
+        announced_at[name] = time.monotonic()
+        ssh_manager.discovery.on_service_state_change(None, SERVICE_TYPE, name, ServiceStateChange.Added)
+    attach_latency = {}
+
+    def record_attached():
+        now = time.monotonic()
+        live = live_imports()
+        for name in fake_servers:
+            if name not in attach_latency and fully_attached(name, live):
+                attach_latency[name] = now - announced_at[name]
+        return len(attach_latency) == len(fake_servers)
+
+    await _wait_until(record_attached, args.timeout)
+    results["discovery_to_attach_s"] = _summary(list(attach_latency.values()))
+
+    # Reconnect: drop the tunnels of a sample of servers and time full recovery.
+    victims = random.sample(sorted(fake_servers), num_victims)
+    old_transports = {name: ssh_manager.sim_transports[name] for name in victims}
+    dropped_at = time.monotonic()
+    for transport in old_transports.values():
+        transport.close()
+    recovery = {}
+
+    def record_recovered():
+        now = time.monotonic()
+        live = live_imports()
+        for name in victims:
+            if (name not in recovery and ssh_manager.sim_transports[name] is not old_transports[name]
+                    and fully_attached(name, live)):
+                recovery[name] = now - dropped_at
+        return len(recovery) == len(victims)
+
+    await _wait_until(record_recovered, args.timeout)
+    results["reconnect_recovery_s"] = _summary(list(recovery.values()))
+
+    # Move: announce a new port for the same sample, so only their tunnels restart.
+    old_transports = {name: ssh_manager.sim_transports[name] for name in victims}
+    moved_at = time.monotonic()
+    for name in victims:
+        zeroconf.services[name] = FakeServiceInfo(name, "127.0.0.1", 2222)
+        ssh_manager.discovery.on_service_state_change(None, SERVICE_TYPE, name, ServiceStateChange.Updated)
+    moved = {}
+
+    def record_moved():
+        now = time.monotonic()
+        live = live_imports()
+        for name in victims:
+            if (name not in moved and ssh_manager.sim_transports[name] is not old_transports[name]
+                    and fully_attached(name, live)):
+                moved[name] = now - moved_at
+        return len(moved) == len(victims)
+
+    await _wait_until(record_moved, args.timeout)
+    results["address_change_recovery_s"] = _summary(list(moved.values()))
+
+    # Configuration change: un-export one device per server and time the detach.
+    changed_at = time.monotonic()
+    for fake in fake_servers.values():
+        await server_thread.call(fake.set_exported, fake.busids[1:])
+
+    def all_attached():
+        live = live_imports()
+        return all(fully_attached(name, live) for name in fake_servers)
+
+    await _wait_until(all_attached, args.timeout)
+    results["config_change_s"] = time.monotonic() - changed_at
+
+    # Device failure: break one device's vhci port per server; only that device should be reattached.
+    broken = {}
+    for port in usb_manager.vhci.read_ports():
+        name = usb_manager._servers_by_local_port.get(port.remote_port)
+        if port.in_use and name is not None and name not in broken:
+            broken[name] = (port.port, port.remote_busid)
+    untouched = {
+        (port.port, port.remote_busid) for port in usb_manager.vhci.read_ports() if port.in_use
+    } - set(broken.values())
+    def recoveries(name: str, busid: str) -> int:
+        return usb_manager._recovery_stats.get((name, busid), [0, 0.0])[0]
+
+    # Earlier phases may have recovered the same devices already, so count from here.
+    recoveries_before = {name: recoveries(name, busid) for name, (_, busid) in broken.items()}
+    failed_at = time.monotonic()
+    fail_ports(sysfs_root, [port for port, _ in broken.values()])
+    repaired = {}
+
+    def record_repaired():
+        now = time.monotonic()
+        live = live_imports()
+        for name, (_, busid) in broken.items():
+            # The new import may land on the same vhci port, so go by the client's recovery record.
+            if (name not in repaired and recoveries(name, busid) > recoveries_before[name]
+                    and fully_attached(name, live)):
+                repaired[name] = now - failed_at
+        return len(repaired) == len(broken)
+
+    await _wait_until(record_repaired, args.timeout)
+    results["device_repair_s"] = _summary(list(repaired.values()))
+    still_there = {(port.port, port.remote_busid) for port in usb_manager.vhci.read_ports() if port.in_use}
+    # Healthy devices must keep their original vhci port through the repair.
+    results["collateral_reattaches"] = len(untouched - still_there)
+
+    # Removal: withdraw every announcement.
+    for name in fake_servers:
+        zeroconf.services.pop(name, None)
+        ssh_manager.discovery.on_service_state_change(None, SERVICE_TYPE, name, ServiceStateChange.Removed)
+    await _wait_until(lambda: not any(usb_manager.attached_devices_by_server.values()), args.timeout)
+
+    cpu_used = _cpu_seconds() - cpu_started
+    results["cpu_s_per_server"] = cpu_used / args.servers
+    # ru_maxrss is in kilobytes on Linux.
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # Health probes also send device list requests, so only the API requests are attributed to syncs.
+    results["api_requests_per_server"] = {
+        kind: sum(fake.requests[kind] for fake in fake_servers.values()) / args.servers
+        for kind in ("exported-devices", "sync-state")
+    }
+    results["relayed_kb_per_server"] = sum(TUNNEL_BYTES._values.values()) / 1024 / args.servers
+    rtt_by_channel = {}
+    for (_, _, channel), (counts, total) in DEVICE_RTT_SECONDS._values.items():
+        samples, sum_s = rtt_by_channel.get(channel, (0, 0.0))
+        rtt_by_channel[channel] = (samples + counts[-1], sum_s + total)
+    results["device_rtt_ms"] = {
+        channel: sum_s / samples * 1000 for channel, (samples, sum_s) in rtt_by_channel.items() if samples
+    }
+    results["incomplete"] = {
+        "attach": len(fake_servers) - len(attach_latency),
+        "reconnect": len(victims) - len(recovery),
+        "address_change": len(victims) - len(moved),
+        "device_repair": len(broken) - len(repaired),
+    }
+
+    await ssh_manager.close()
+    for fake in fake_servers.values():
+        await server_thread.run(fake.close())
+    await server_thread.call(driver.close)
+    await server_thread.stop()
+    await profiling.disable()
+    return results
+
+
+def print_report(results: dict):
+    print(f"Servers: {results['servers']}, devices per server: {results['devices_per_server']}")
+    for key, label in (
+        ("discovery_to_attach_s", "Discovery to attach"),
+        ("reconnect_recovery_s", "Reconnect recovery"),
+        ("address_change_recovery_s", "Address change"),
+        ("device_repair_s", "Device repair"),
+    ):
+        stats = results[key]
+        if stats["count"]:
+            print(
+                f"{label:<22} n={stats['count']:<5} p50={stats['p50']:.3f}s "
+                f"p95={stats['p95']:.3f}s max={stats['max']:.3f}s"
+            )
+        else:
+            print(f"{label:<22} no samples")
+    print(f"{'Config change':<22} {results['config_change_s']:.3f}s")
+    print(f"{'Collateral reattaches':<22} {results['collateral_reattaches']}")
+    print(f"{'CPU per server':<22} {results['cpu_s_per_server'] * 1000:.1f} ms")
+    print(f"{'Peak RSS':<22} {results['max_rss_mb']:.1f} MB")
+    requests = ", ".join(f"{kind} {count:.1f}" for kind, count in results["api_requests_per_server"].items())
+    print(f"{'API requests/server':<22} {requests}")
+    print(f"{'Relayed per server':<22} {results['relayed_kb_per_server']:.1f} KB")
+    for channel, rtt_ms in sorted(results["device_rtt_ms"].items()):
+        print(f"{'Device RTT ' + channel:<22} {rtt_ms:.2f} ms mean")
+    if any(results["incomplete"].values()):
+        print(f"Incomplete: {results['incomplete']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="USB Beamer client simulation harness")
+    parser.add_argument('--servers', type=int, default=10, help='Number of fake servers')
+    parser.add_argument('--devices', type=int, default=4, help='Devices exported per server')
+    parser.add_argument(
+        '--realtime-devices', type=int, default=0,
+        help='Devices per server marked realtime, which get a dedicated channel'
+    )
+    parser.add_argument('--handshake-concurrency', type=int, default=4, help='Client handshake concurrency')
+    parser.add_argument(
+        '--legacy-api', action='store_true', help='Fake servers without the combined sync endpoint'
+    )
+    parser.add_argument('--attach-concurrency', type=int, default=4, help='Client attach concurrency')
+    parser.add_argument(
+        '--reconnect-fraction', type=float, default=0.25, help='Share of servers whose tunnel is dropped'
+    )
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for each phase')
+    parser.add_argument('--trace', help='Write a Chrome trace of the client to this file')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--log-level', default='WARNING', help='Client logging level')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    results = asyncio.run(run_simulation(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+    return 1 if any(results["incomplete"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())